@@ -0,0 +1,569 @@
+"""
+@File    :   benchmark.py
+@Time    :   2023/12/21 14:36:18
+@Author  :   TankNee
+@Version :   1.0
+@Desc    :   在合成的比赛视频和字幕上测量各阶段的吞吐量，并与基准结果比较
+"""
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import get_context
+from urllib.parse import parse_qs, urlparse
+
+from loguru import logger
+
+import metrics
+from common import create_logger, read_json, write_json
+
+STAGES = [
+    "cut",
+    "split",
+    "extract",
+    "split_keyframes",
+    "recognize",
+    "metadata",
+    "subtitle",
+    "refine",
+]
+# 指标是否越大越好，与基准相比超出 tolerance 时视为退化
+METRICS = {
+    "items_per_sec": True,
+    "realtime_factor": True,
+    "peak_rss_mb": False,
+    "peak_child_rss_mb": False,
+}
+# 合成输入的参数，参数不同的结果之间不能比较
+INPUT_PARAMS = ["duration", "num_videos", "size", "fps", "line_duration", "requests"]
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--work_dir", type=str, default="./.cache/bench", help="合成输入和输出目录")
+    parser.add_argument("--stages", type=str, nargs="+", default=STAGES, choices=STAGES)
+    parser.add_argument("--duration", type=float, default=300, help="每个合成视频的时长（秒）")
+    parser.add_argument("--num_videos", type=int, default=2)
+    parser.add_argument("--size", type=str, default="854x480")
+    parser.add_argument("--fps", type=int, default=25)
+    parser.add_argument("--line_duration", type=float, default=3.0, help="每句字幕的时长（秒）")
+    parser.add_argument("--requests", type=int, default=200, help="网络阶段的请求数量")
+    parser.add_argument("--interval", type=int, default=30, help="split 的片段时长")
+    parser.add_argument("--split_mode", type=str, default="copy", choices=["copy", "reencode"])
+    parser.add_argument("--num_key_frames", type=int, default=15)
+    parser.add_argument("--engine", type=str, default="native", choices=["native", "katna"])
+    parser.add_argument("--model_path", type=str, default="tiny", help="recognize 使用的模型")
+    parser.add_argument("--workers", type=int, default=8, help="网络阶段的并发数")
+    parser.add_argument("--baseline", type=str, default="config/bench_baseline.json")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="允许的相对退化比例")
+    parser.add_argument("--update_baseline", action="store_true", help="把本次结果保存为基准")
+    parser.add_argument("--output", type=str, default="outputs/bench.json")
+    return parser.parse_args()
+
+
+# ---------------- 合成输入 ----------------
+
+
+def generate_video(path: str, duration: float, size: str, fps: int):
+    # testsrc 画面 + 正弦音轨，GOP 与 B 站视频一样为 2 秒
+    subprocess.run(
+        [
+            "ffmpeg",
+            "-y",
+            "-v",
+            "error",
+            "-f",
+            "lavfi",
+            "-i",
+            f"testsrc=duration={duration}:size={size}:rate={fps}",
+            "-f",
+            "lavfi",
+            "-i",
+            f"sine=frequency=440:sample_rate=16000:duration={duration}",
+            "-c:v",
+            "libx264",
+            "-preset",
+            "ultrafast",
+            "-g",
+            str(fps * 2),
+            "-pix_fmt",
+            "yuv420p",
+            "-c:a",
+            "aac",
+            "-shortest",
+            path,
+        ],
+        check=True,
+    )
+
+
+def generate_subtitle(path: str, duration: float, line_duration: float):
+    # 与 B 站字幕相同的格式：body 中每句台词有 from、to、content
+    body = []
+    start = 0.0
+    while start < duration:
+        body.append(
+            {
+                "from": round(start, 3),
+                "to": round(min(start + line_duration * 0.9, duration), 3),
+                "content": f"第{len(body)}句解说词，上路打得很激烈",
+            }
+        )
+        start += line_duration
+    write_json(path, {"body": body})
+
+
+def prepare_inputs(args) -> dict:
+    """生成合成视频和字幕，参数不变时复用上次生成的文件"""
+    tag = f"{int(args.duration)}s_{args.size}_{args.fps}fps"
+    input_dir = os.path.join(args.work_dir, "inputs", tag)
+    os.makedirs(input_dir, exist_ok=True)
+    videos, subtitles = [], []
+    for i in range(args.num_videos):
+        video_path = os.path.join(input_dir, f"TES_JDG_20230415_{i + 1}.mp4")
+        subtitle_path = os.path.join(input_dir, f"TES_JDG_20230415_{i + 1}.json")
+        if not os.path.exists(video_path):
+            logger.info(f"Generate {video_path}")
+            tmp_path = video_path.replace(".mp4", ".tmp.mp4")
+            generate_video(tmp_path, args.duration, args.size, args.fps)
+            os.replace(tmp_path, video_path)
+        generate_subtitle(subtitle_path, args.duration, args.line_duration)
+        videos.append(video_path)
+        subtitles.append(subtitle_path)
+    return {"videos": videos, "subtitles": subtitles}
+
+
+def get_clip_duration(clip_path: str) -> float:
+    # 片段文件名为 {视频名}_{开始}_{结束}.mp4
+    _, start, end = os.path.basename(clip_path)[: -len(".mp4")].rsplit("_", 2)
+    return float(end) - float(start)
+
+
+def prepare_clips(inputs: dict, args) -> list:
+    """extract 需要切分好的片段，在计时之外准备"""
+    from split import cut_subtitle, split_video
+
+    clip_dir = os.path.join(args.work_dir, "clips", f"{int(args.duration)}s_{args.interval}")
+    if not os.path.exists(os.path.join(clip_dir, "_SUCCESS")):
+        shutil.rmtree(clip_dir, ignore_errors=True)
+        for video_path, subtitle_path in zip(inputs["videos"], inputs["subtitles"]):
+            subtitle = cut_subtitle(read_json(subtitle_path), 0)
+            split_video(video_path, subtitle, clip_dir, args.interval, progress=False)
+        with open(os.path.join(clip_dir, "_SUCCESS"), "w"):
+            pass
+    videos_dir = os.path.join(clip_dir, "videos")
+    return sorted(os.path.join(videos_dir, name) for name in os.listdir(videos_dir))
+
+
+# ---------------- 本地桩服务器 ----------------
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """模拟 B 站的 view、player、字幕接口和 OpenAI 的 chat completions 接口"""
+
+    def log_message(self, *args):
+        pass
+
+    def _send_json(self, data: dict):
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path == "/x/web-interface/view":
+            bvid = query["bvid"][0]
+            self._send_json(
+                {
+                    "data": {
+                        "aid": abs(hash(bvid)) % 10**9,
+                        "title": "4月15日 LPL春季赛 TES vs JDG",
+                        "pages": [
+                            {"cid": i + 1, "part": f"第{i + 1}局"} for i in range(3)
+                        ],
+                    }
+                }
+            )
+        elif url.path == "/x/player/v2":
+            subtitle_url = f"//{self.headers['Host']}/subtitle/{query['cid'][0]}.json"
+            self._send_json(
+                {
+                    "data": {
+                        "subtitle": {"subtitles": [{"subtitle_url": subtitle_url}]},
+                        "view_points": [{"from": 0}, {"from": 600}],
+                    }
+                }
+            )
+        elif url.path.startswith("/subtitle/"):
+            body = [
+                {"from": i * 3.0, "to": i * 3.0 + 2.7, "content": f"第{i}句解说词"}
+                for i in range(1000)
+            ]
+            self._send_json({"body": body})
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length))
+        content = request["messages"][-1]["content"][-200:]
+        self._send_json(
+            {
+                "id": "chatcmpl-bench",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request["model"],
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": content},
+                        "finish_reason": "stop",
+                    }
+                ],
+                "usage": {"prompt_tokens": 100, "completion_tokens": 50, "total_tokens": 150},
+            }
+        )
+
+
+def start_stub_server() -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# ---------------- 各阶段，返回 (数量, 媒体时长, 计时秒数) ----------------
+
+
+def bench_cut(inputs: dict, args, output_dir: str):
+    from cut import cut_video
+
+    start = time.perf_counter()
+    for video_path in inputs["videos"]:
+        output_file = os.path.join(output_dir, os.path.basename(video_path))
+        cut_video(video_path, output_file, str(args.duration * 0.1))
+    seconds = time.perf_counter() - start
+    return len(inputs["videos"]), args.duration * len(inputs["videos"]), seconds
+
+
+def bench_split(inputs: dict, args, output_dir: str):
+    from split import cut_subtitle, split_video
+
+    start = time.perf_counter()
+    num_clips = 0
+    for video_path, subtitle_path in zip(inputs["videos"], inputs["subtitles"]):
+        subtitle = cut_subtitle(read_json(subtitle_path), 0)
+        num_clips += len(
+            split_video(
+                video_path,
+                subtitle,
+                output_dir,
+                args.interval,
+                mode=args.split_mode,
+                progress=False,
+            )
+        )
+    seconds = time.perf_counter() - start
+    return num_clips, args.duration * len(inputs["videos"]), seconds
+
+
+def bench_extract(inputs: dict, args, output_dir: str):
+    from extract import extract_keyframes
+
+    os.makedirs(os.path.join(output_dir, "keyframes"), exist_ok=True)
+    start = time.perf_counter()
+    for clip_path in inputs["clips"]:
+        extract_keyframes(clip_path, output_dir, args.num_key_frames, args.engine)
+    seconds = time.perf_counter() - start
+    media_seconds = sum(get_clip_duration(clip) for clip in inputs["clips"])
+    return len(inputs["clips"]), media_seconds, seconds
+
+
+def bench_split_keyframes(inputs: dict, args, output_dir: str):
+    # 切分并提取关键帧，只解码一遍，对比 split + extract 的合计耗时
+    from split import cut_subtitle, split_video_fused
+
+    start = time.perf_counter()
+    num_clips = 0
+    for video_path, subtitle_path in zip(inputs["videos"], inputs["subtitles"]):
+        subtitle = cut_subtitle(read_json(subtitle_path), 0)
+        num_clips += len(
+            split_video_fused(
+                video_path,
+                subtitle,
+                output_dir,
+                args.interval,
+                num_key_frames=args.num_key_frames,
+                progress=False,
+            )
+        )
+    seconds = time.perf_counter() - start
+    return num_clips, args.duration * len(inputs["videos"]), seconds
+
+
+def bench_recognize(inputs: dict, args, output_dir: str):
+    from faster_whisper import WhisperModel
+
+    from recognize import load_audio, recognize
+
+    # 模型加载不计入转写时间
+    model = WhisperModel(args.model_path, device="cpu", compute_type="int8")
+    start = time.perf_counter()
+    for video_path in inputs["videos"]:
+        recognize(model, video_path, load_audio(video_path))
+    seconds = time.perf_counter() - start
+    return len(inputs["videos"]), args.duration * len(inputs["videos"]), seconds
+
+
+def bench_metadata(inputs: dict, args, output_dir: str):
+    from download import get_video_info_http
+
+    urls = [
+        f"https://www.bilibili.com/video/BV{i:010d}" for i in range(args.requests)
+    ]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        list(executor.map(get_video_info_http, urls))
+    seconds = time.perf_counter() - start
+    return len(urls), None, seconds
+
+
+def bench_subtitle(inputs: dict, args, output_dir: str):
+    import asyncio
+
+    from catalog import Catalog
+    from subtitle import fetch_all
+
+    catalog = Catalog(os.path.join(output_dir, "catalog.sqlite"))
+    # 每条记录 2 个分P，两次请求得到一个字幕
+    catalog.upsert_many(
+        [
+            {
+                "url": f"https://www.bilibili.com/video/BV{i:010d}",
+                "teams": ["TES", f"T{i}"],
+                "date": "20230415",
+                "playlist_idx": [1, 2],
+                "start_point": 600,
+            }
+            for i in range(args.requests // 2)
+        ]
+    )
+    fetch_args = argparse.Namespace(
+        output_dir=output_dir, rpm=10**9, connections=args.workers
+    )
+    start = time.perf_counter()
+    asyncio.run(fetch_all(fetch_args, catalog))
+    seconds = time.perf_counter() - start
+    catalog.close()
+    num_subtitles = sum(name.endswith(".json") for name in os.listdir(output_dir))
+    return num_subtitles, None, seconds
+
+
+def bench_refine(inputs: dict, args, output_dir: str):
+    import asyncio
+
+    import refine
+    from common import JsonlAppender
+
+    subtitle_dir = os.path.join(output_dir, "subtitles")
+    os.makedirs(subtitle_dir)
+    subtitles = []
+    for i in range(args.requests):
+        subtitle_path = os.path.join(subtitle_dir, f"clip_{i}.json")
+        write_json(
+            subtitle_path,
+            [
+                {"start": j * 3.0, "end": j * 3.0 + 2.7, "text": f"片段{i}第{j}句解说词"}
+                for j in range(10)
+            ],
+        )
+        subtitles.append(subtitle_path)
+    # 只测客户端本身，不受限速影响
+    refine_args = refine.get_args([])
+    refine_args.rpm = refine_args.tpm = 10**9
+    refine_args.min_concurrency = refine_args.max_concurrency = args.workers
+    start = time.perf_counter()
+    with JsonlAppender(os.path.join(output_dir, "results.jsonl")) as writer:
+        asyncio.run(refine.refine_all_async(subtitles, writer, refine_args))
+    seconds = time.perf_counter() - start
+    return len(subtitles), None, seconds
+
+
+BENCHMARKS = {
+    "cut": bench_cut,
+    "split": bench_split,
+    "extract": bench_extract,
+    "split_keyframes": bench_split_keyframes,
+    "recognize": bench_recognize,
+    "metadata": bench_metadata,
+    "subtitle": bench_subtitle,
+    "refine": bench_refine,
+}
+
+
+def _run_stage(stage: str, inputs: dict, args, output_dir: str) -> dict:
+    # 在新进程中运行，峰值内存只包含这一个阶段
+    items, media_seconds, seconds = BENCHMARKS[stage](inputs, args, output_dir)
+    result = {
+        "seconds": round(seconds, 3),
+        "items": items,
+        "items_per_sec": round(items / seconds, 3) if seconds else None,
+        # ru_maxrss 在 Linux 上的单位是 KB
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "peak_child_rss_mb": round(
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1
+        ),
+    }
+    if media_seconds is not None:
+        result["realtime_factor"] = round(media_seconds / seconds, 3)
+    return result
+
+
+def run_stage(stage: str, inputs: dict, args) -> dict:
+    output_dir = os.path.join(args.work_dir, "outputs", stage)
+    shutil.rmtree(output_dir, ignore_errors=True)
+    os.makedirs(output_dir)
+    # 每次都清空 ffprobe 缓存，测量的是冷启动的速度
+    shutil.rmtree(os.environ["MEDIA_CACHE_DIR"], ignore_errors=True)
+    with get_context("spawn").Pool(1) as pool:
+        return pool.apply(_run_stage, (stage, inputs, args, output_dir))
+
+
+# ---------------- 与基准比较 ----------------
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    regressions = []
+    for stage, stage_metrics in results.items():
+        if "error" in stage_metrics:
+            continue
+        base = baseline.get(stage)
+        if not base:
+            # 没有基准的阶段无法判断是否退化，不能算作通过
+            regressions.append(f"{stage}: no baseline, run with --update_baseline first")
+            continue
+        for key, higher_is_better in METRICS.items():
+            if not stage_metrics.get(key) or not base.get(key):
+                continue
+            ratio = stage_metrics[key] / base[key]
+            if (higher_is_better and ratio < 1 - tolerance) or (
+                not higher_is_better and ratio > 1 + tolerance
+            ):
+                regressions.append(
+                    f"{stage}.{key}: {stage_metrics[key]} vs baseline {base[key]} "
+                    f"({ratio:.2f}x)"
+                )
+    return regressions
+
+
+def report(results: dict, baseline: dict):
+    logger.info(
+        f"{'stage':<10}{'items/s':>10}{'realtime':>10}{'rss MB':>10}{'child MB':>10}{'vs base':>10}"
+    )
+    for stage, stage_metrics in results.items():
+        if "error" in stage_metrics:
+            logger.info(f"{stage:<10} skipped: {stage_metrics['error']}")
+            continue
+        base = baseline.get(stage, {})
+        speedup = (
+            f"{stage_metrics['items_per_sec'] / base['items_per_sec']:.2f}x"
+            if base.get("items_per_sec")
+            else "-"
+        )
+        realtime = stage_metrics.get("realtime_factor", "-")
+        logger.info(
+            f"{stage:<10}{stage_metrics['items_per_sec']:>10}{realtime:>10}"
+            f"{stage_metrics['peak_rss_mb']:>10}{stage_metrics['peak_child_rss_mb']:>10}"
+            f"{speedup:>10}"
+        )
+
+
+def main():
+    create_logger("./logs/benchmark.log")
+    args = get_args()
+    # 各阶段子进程里的耗时明细写到 work_dir，不混入正式运行的统计
+    metrics.init("benchmark", os.path.join(args.work_dir, "metrics"))
+    os.makedirs(args.work_dir, exist_ok=True)
+    os.environ["MEDIA_CACHE_DIR"] = os.path.join(args.work_dir, "media_cache")
+    # 网络阶段连接本地桩服务器，子进程导入 bilibili 时读取这些环境变量
+    server = start_stub_server()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    os.environ["BILIBILI_API_BASE"] = base_url
+    os.environ["OPENAI_BASE_URL"] = base_url + "/v1"
+    os.environ["OPENAI_API_KEY"] = "bench"
+
+    inputs = prepare_inputs(args)
+    if "extract" in args.stages:
+        inputs["clips"] = prepare_clips(inputs, args)
+
+    results = {}
+    failures = []
+    for stage in args.stages:
+        logger.info(f"Benchmark {stage}")
+        try:
+            results[stage] = run_stage(stage, inputs, args)
+        except ImportError as e:
+            # 例如没有安装 faster-whisper 时跳过 recognize
+            logger.warning(f"Skip {stage}: {e}")
+            results[stage] = {"error": str(e)}
+        except Exception as e:
+            logger.exception(f"Benchmark {stage} failed")
+            results[stage] = {"error": str(e)}
+            failures.append(f"{stage} failed: {e}")
+    server.shutdown()
+
+    params = {key: getattr(args, key) for key in INPUT_PARAMS}
+    output = {"params": params, "stages": results}
+    if os.path.dirname(args.output):
+        os.makedirs(os.path.dirname(args.output), exist_ok=True)
+    write_json(args.output, output)
+
+    baseline = {}
+    if not os.path.exists(args.baseline):
+        logger.warning(f"Baseline {args.baseline} does not exist")
+    else:
+        baseline_output = read_json(args.baseline)
+        if baseline_output["params"] == params:
+            baseline = baseline_output["stages"]
+        else:
+            logger.warning(
+                f"Baseline {args.baseline} was measured with "
+                f"{baseline_output['params']}, cannot compare"
+            )
+    report(results, baseline)
+
+    if args.update_baseline:
+        # 只覆盖本次运行成功的阶段
+        if os.path.exists(args.baseline):
+            baseline_output = read_json(args.baseline)
+            if baseline_output["params"] != params:
+                baseline_output = {"params": params, "stages": {}}
+        else:
+            baseline_output = {"params": params, "stages": {}}
+        baseline_output["stages"].update(
+            {stage: m for stage, m in results.items() if "error" not in m}
+        )
+        write_json(args.baseline, baseline_output)
+        logger.info(f"Save baseline to {args.baseline}")
+        return
+
+    regressions = failures + compare(results, baseline, args.tolerance)
+    if regressions:
+        for regression in regressions:
+            logger.error(f"REGRESSION {regression}")
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+@File    :   bilibili.py
+@Time    :   2023/12/15 10:47:19
+@Author  :   TankNee
+@Version :   1.0
+@Desc    :   B 站接口的 HTTP 客户端，所有请求共用一个保持长连接的 Session
+"""
+
+import os
+import re
+import threading
+from urllib.parse import urljoin
+
+import requests
+from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import metrics
+
+load_dotenv()
+
+# 可以指向本地的录制数据服务器进行测试
+API_BASE = os.getenv("BILIBILI_API_BASE", "https://api.bilibili.com")
+VIEW_URL = API_BASE + "/x/web-interface/view"
+PLAYER_URL = API_BASE + "/x/player/v2"
+
+headers = {
+    "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/117.0.0.0 Safari/537.36",
+    "Cookie": os.getenv("COOKIE"),
+}
+
+_local = threading.local()
+
+
+def get_session(pool_size: int = 16) -> requests.Session:
+    # requests.Session 不保证线程安全，每个线程一个 Session，各自复用连接
+    session = getattr(_local, "session", None)
+    if session is None:
+        session = requests.Session()
+        session.headers.update({k: v for k, v in headers.items() if v})
+        adapter = HTTPAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+            max_retries=Retry(
+                total=3, backoff_factor=1, status_forcelist=[412, 429, 500, 502, 503]
+            ),
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        _local.session = session
+    return session
+
+
+def get_json(url: str, params: dict = None, timeout: float = 10) -> dict:
+    host = metrics.get_host(url)
+    with metrics.span("http.get", host=host):
+        response = get_session().get(url, params=params, timeout=timeout)
+        response.raise_for_status()
+    metrics.observe("http_response_bytes", len(response.content), host=host)
+    return response.json()
+
+
+def get_data(text: dict) -> dict:
+    """检查接口返回的 code 并取出 data，同步和异步的客户端共用"""
+    if text.get("code", 0) != 0:
+        raise ValueError(f"Bilibili API error {text.get('code')}: {text.get('message')}")
+    return text.get("data") or {}
+
+
+def get_subtitle_url(player: dict):
+    """播放器信息中第一条字幕的完整地址，没有字幕时返回 None"""
+    subtitles = (player.get("subtitle") or {}).get("subtitles") or []
+    if not subtitles or not subtitles[0].get("subtitle_url"):
+        return None
+    # subtitle_url 形如 //aisubtitle.hdslb.com/...，补全协议
+    return urljoin(API_BASE, subtitles[0]["subtitle_url"])
+
+
+def get_bvid(video_url: str) -> str:
+    match = re.search(r"BV[0-9A-Za-z]{10}", video_url)
+    if match is None:
+        raise ValueError(f"Cannot find bvid in {video_url}")
+    return match.group(0)
+
+
+def get_view(bvid: str) -> dict:
+    """视频信息，包含 title、aid 以及每一个分P的 pages"""
+    return get_data(get_json(VIEW_URL, params={"bvid": bvid}))
+
+
+def get_player(cid, aid, bvid) -> dict:
+    """播放器信息，包含字幕列表和进度条上的高能看点 view_points"""
+    return get_data(get_json(PLAYER_URL, params={"cid": cid, "aid": aid, "bvid": bvid}))
+
+
+def get_start_point(cid, aid, bvid):
+    """进度条上第一个看点的时间（秒），没有看点时返回 None"""
+    view_points = get_player(cid, aid, bvid).get("view_points") or []
+    for point in view_points:
+        if point.get("from"):
+            return int(point["from"])
+    return None
+
+
+def get_subtitle(cid, aid, bvid):
+    """第一条字幕的内容，没有字幕时返回 None"""
+    subtitle_url = get_subtitle_url(get_player(cid, aid, bvid))
+    if subtitle_url is None:
+        return None
+    return get_json(subtitle_url)
@@ -0,0 +1,116 @@
+"""
+@File    :   browser.py
+@Time    :   2023/12/14 14:31:08
+@Author  :   TankNee
+@Version :   1.0
+@Desc    :   复用的无界面 Chrome 浏览器池，用显式等待代替固定的 sleep
+"""
+
+import contextlib
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from loguru import logger
+from selenium import webdriver
+from selenium.common.exceptions import TimeoutException, WebDriverException
+from selenium.webdriver.chrome.options import Options
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.webdriver.support.ui import WebDriverWait
+
+PLAYLIST_SELECTOR = "#multi_page > div.cur-list > ul"
+ICON_LIST_SELECTOR = "#bilibili-player > div > div > div.bpx-player-primary-area > div.bpx-player-video-area > div.bpx-player-control-wrap > div.bpx-player-control-entity > div.bpx-player-control-top > div > div.bpx-player-progress-freezone"
+START_POINT_SELECTOR = f"{ICON_LIST_SELECTOR} img[data-seek]"
+
+
+class BrowserPool:
+    """最多同时存在 size 个浏览器，用完放回池中，崩溃的浏览器会被丢弃并在下次使用时重建"""
+
+    def __init__(self, size: int = 4, timeout: float = 20):
+        self.size = size
+        self.timeout = timeout
+        self.idle = queue.Queue()
+        self.drivers = []
+        self.lock = threading.Lock()
+
+    def _create_driver(self):
+        # 创建Chrome浏览器选项
+        chrome_options = Options()
+        chrome_options.add_argument("--headless")  # 无界面模式
+        return webdriver.Chrome(options=chrome_options)
+
+    def _acquire(self):
+        while True:
+            try:
+                return self.idle.get_nowait()
+            except queue.Empty:
+                pass
+            with self.lock:
+                if len(self.drivers) < self.size:
+                    driver = self._create_driver()
+                    self.drivers.append(driver)
+                    return driver
+            # 有浏览器被丢弃时等待者需要重新检查是否可以新建
+            try:
+                return self.idle.get(timeout=1)
+            except queue.Empty:
+                continue
+
+    def _discard(self, driver):
+        with self.lock:
+            if driver in self.drivers:
+                self.drivers.remove(driver)
+        try:
+            driver.quit()
+        except Exception:
+            pass
+
+    @contextlib.contextmanager
+    def driver(self):
+        driver = self._acquire()
+        try:
+            yield driver
+        except TimeoutException:
+            self.idle.put(driver)
+            raise
+        except WebDriverException:
+            logger.warning("Browser crashed, discard it")
+            self._discard(driver)
+            raise
+        except BaseException:
+            self.idle.put(driver)
+            raise
+        else:
+            self.idle.put(driver)
+
+    def wait(self, driver, selector: str):
+        """等待 selector 对应的元素出现，超时抛出 TimeoutException"""
+        return WebDriverWait(driver, self.timeout).until(
+            EC.presence_of_element_located((By.CSS_SELECTOR, selector))
+        )
+
+    def open(self, driver, url: str, selector: str):
+        """打开网页并等待 selector 对应的元素出现"""
+        driver.get(url)
+        return self.wait(driver, selector)
+
+    def map(self, func, items):
+        """并发执行 func(pool, item)，结果顺序与 items 一致"""
+        with ThreadPoolExecutor(max_workers=self.size) as executor:
+            return list(executor.map(lambda item: func(self, item), items))
+
+    def close(self):
+        with self.lock:
+            drivers, self.drivers = self.drivers, []
+        for driver in drivers:
+            try:
+                driver.quit()
+            except Exception:
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,189 @@
+"""
+@File    :   catalog.py
+@Time    :   2023/12/18 15:02:44
+@Author  :   TankNee
+@Version :   1.0
+@Desc    :   比赛元信息目录，使用 SQLite 保存比赛记录与每个分P在各阶段的状态
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from bilibili import get_bvid
+from common import iter_jsonl, write_jsonl
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS matches (
+    url TEXT PRIMARY KEY,
+    bvid TEXT,
+    teams TEXT,
+    date TEXT,
+    playlist_idx TEXT,
+    start_point INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_matches_bvid ON matches (bvid);
+CREATE INDEX IF NOT EXISTS idx_matches_date ON matches (date);
+CREATE INDEX IF NOT EXISTS idx_matches_teams ON matches (teams);
+CREATE TABLE IF NOT EXISTS part_start_points (
+    name TEXT PRIMARY KEY,
+    start_point INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS part_status (
+    name TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    status TEXT NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (name, stage)
+);
+"""
+
+
+def get_part_name(record: dict, idx: int) -> str:
+    """第 idx 个（从 0 开始）比赛分P的文件名，不含扩展名"""
+    return f"{'_'.join(record['teams'])}_{record['date']}_{idx + 1}"
+
+
+class Catalog:
+    def __init__(self, path: str = "config/catalog.sqlite"):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.executescript(SCHEMA)
+        # 旧版本取 URL 最后一段作为 bvid，带查询参数的 URL 会存成错误的值
+        self.conn.executemany(
+            "UPDATE matches SET bvid = ? WHERE url = ?",
+            [
+                (get_bvid(row["url"]), row["url"])
+                for row in self.conn.execute("SELECT url, bvid FROM matches")
+                if get_bvid(row["url"]) != row["bvid"]
+            ],
+        )
+        self.conn.commit()
+
+    @staticmethod
+    def _to_row(record: dict) -> tuple:
+        return (
+            record["url"],
+            get_bvid(record["url"]),
+            "_".join(record["teams"]) if record.get("teams") else None,
+            record.get("date"),
+            json.dumps(record["playlist_idx"])
+            if record.get("playlist_idx") is not None
+            else None,
+            record.get("start_point"),
+        )
+
+    @staticmethod
+    def _to_record(row) -> dict:
+        return {
+            "url": row["url"],
+            "teams": row["teams"].split("_") if row["teams"] else None,
+            "date": row["date"],
+            "playlist_idx": json.loads(row["playlist_idx"])
+            if row["playlist_idx"]
+            else None,
+            "start_point": row["start_point"],
+        }
+
+    def upsert_many(self, records: list, overwrite: bool = True):
+        """在一个事务中写入多条记录，overwrite=False 时只插入不存在的记录"""
+        verb = "INSERT OR REPLACE" if overwrite else "INSERT OR IGNORE"
+        with self.lock, self.conn:
+            self.conn.executemany(
+                f"{verb} INTO matches (url, bvid, teams, date, playlist_idx, start_point) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [self._to_row(record) for record in records],
+            )
+
+    def upsert(self, record: dict):
+        self.upsert_many([record])
+
+    def get(self, url: str):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT * FROM matches WHERE url = ?", (url,)
+            ).fetchone()
+        return self._to_record(row) if row is not None else None
+
+    def find(self, bvid: str = None, date: str = None, teams: list = None) -> list:
+        conditions, params = [], []
+        for column, value in (("bvid", bvid), ("date", date)):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+        if teams is not None:
+            conditions.append("teams = ?")
+            params.append("_".join(teams))
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        with self.lock:
+            rows = self.conn.execute(
+                f"SELECT * FROM matches {where} ORDER BY rowid", params
+            ).fetchall()
+        return [self._to_record(row) for row in rows]
+
+    def records(self, matches_only: bool = False) -> list:
+        """所有记录，matches_only=True 时只返回有比赛分P的记录"""
+        records = self.find()
+        if matches_only:
+            records = [r for r in records if r["teams"] and r["playlist_idx"]]
+        return records
+
+    def parts(self) -> list:
+        """所有比赛分P，返回 [(part_name, part_url, record), ...]"""
+        parts = []
+        for record in self.records(matches_only=True):
+            for idx, p_idx in enumerate(record["playlist_idx"]):
+                part_url = record["url"] + f"?p={p_idx}"
+                parts.append((get_part_name(record, idx), part_url, record))
+        return parts
+
+    def set_status(self, name: str, stage: str, status: str = "done"):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO part_status (name, stage, status, updated) "
+                "VALUES (?, ?, ?, ?)",
+                (name, stage, status, time.time()),
+            )
+
+    def get_status(self, name: str, stage: str):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT status FROM part_status WHERE name = ? AND stage = ?",
+                (name, stage),
+            ).fetchone()
+        return row["status"] if row is not None else None
+
+    def set_start_point(self, name: str, start_point: int):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO part_start_points (name, start_point) VALUES (?, ?)",
+                (name, start_point),
+            )
+
+    def get_start_point(self, name: str, part_url: str, record: dict):
+        """分P的开始时间，记录中的 start_point 来自默认打开的 p=1"""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT start_point FROM part_start_points WHERE name = ?", (name,)
+            ).fetchone()
+        if row is not None:
+            return row["start_point"]
+        if part_url.endswith("?p=1") and record.get("start_point") is not None:
+            return record["start_point"]
+        return None
+
+    def import_jsonl(self, file_path: str, overwrite: bool = False):
+        if os.path.exists(file_path):
+            self.upsert_many(iter_jsonl(file_path), overwrite=overwrite)
+
+    def export_jsonl(self, file_path: str):
+        write_jsonl(file_path, self.records())
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -1,10 +1,21 @@
+import asyncio
 import functools
 import json
+import os
+import queue
+import threading
 import time
 
 import yaml
 from loguru import logger
 
+import metrics
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 def read_yaml(file_path):
     with open(file_path, "r", encoding="utf-8") as f:
@@ -16,26 +27,197 @@ def write_yaml(file_path, data):
         yaml.dump(data, f, allow_unicode=True)
 
 
+def dumps(data, indent=False) -> bytes:
+    """序列化为 UTF-8 字节，不缩进时如果安装了 orjson 则使用 orjson
+
+    缩进格式始终由标准库输出（4 个空格），文件格式与是否安装 orjson 无关
+    """
+    if indent:
+        return json.dumps(data, ensure_ascii=False, indent=4).encode("utf-8")
+    if orjson is not None:
+        try:
+            return orjson.dumps(data)
+        except TypeError:
+            # orjson 不支持的类型（例如非字符串的键）退回标准库
+            pass
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _write_bytes(file_path, data: bytes, atomic=False):
+    if not atomic:
+        with open(file_path, "wb") as f:
+            f.write(data)
+        return
+    # 先写临时文件再重命名，中断时不会留下半个文件
+    tmp_path = f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, file_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
 def read_json(file_path):
-    with open(file_path, "r", encoding="utf-8") as f:
-        return json.load(f)
+    with open(file_path, "rb") as f:
+        return loads(f.read())
 
 
-def read_jsonl(file_path):
-    with open(file_path, "r", encoding="utf-8") as f:
-        return [json.loads(line) for line in f]
+def write_json(file_path, data, compact=False, atomic=False):
+    """compact=True 时不缩进，用于数量很多的片段字幕文件"""
+    _write_bytes(file_path, dumps(data, indent=not compact), atomic)
 
 
-def write_json(file_path, data):
-    with open(file_path, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=4)
+def iter_jsonl(file_path):
+    """逐行读取 jsonl，中断时写了一半的最后一行会被跳过"""
+    with open(file_path, "rb") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            if not line.endswith(b"\n"):
+                # 只有最后一行可能没有换行符
+                try:
+                    record = loads(line)
+                except ValueError:
+                    logger.warning(f"Skip truncated last line of {file_path}")
+                    return
+                yield record
+                return
+            yield loads(line)
 
 
-def write_jsonl(file_path, data):
-    with open(file_path, "w", encoding="utf-8") as f:
+def read_jsonl(file_path):
+    return list(iter_jsonl(file_path))
+
+
+def write_jsonl(file_path, data, atomic=True):
+    """data 可以是生成器，全部写完后再替换原文件"""
+    with JsonlWriter(file_path, mode="w", atomic=atomic) as writer:
         for line in data:
-            json.dump(line, f, ensure_ascii=False)
-            f.write("\n")
+            writer.write(line)
+
+
+def _repair_tail(file_path):
+    # 上次追加时中断留下的半行会和下一条记录粘在一起，先截掉
+    if not os.path.exists(file_path):
+        return
+    with open(file_path, "rb+") as f:
+        size = f.seek(0, os.SEEK_END)
+        if size == 0:
+            return
+        f.seek(size - 1)
+        if f.read(1) == b"\n":
+            return
+        block = min(size, 1 << 20)
+        while True:
+            f.seek(size - block)
+            tail = f.read(block)
+            idx = tail.rfind(b"\n")
+            if idx >= 0 or block == size:
+                break
+            block = min(size, block * 2)
+        f.truncate(size - block + idx + 1)
+        logger.warning(f"Truncate partial last line of {file_path}")
+
+
+class JsonlWriter:
+    """按批写 jsonl，每批用一次 write 追加完整的行
+
+    mode="a" 时追加到已有文件，mode="w" 且 atomic=True 时先写临时文件，close 时替换原文件
+    """
+
+    def __init__(self, file_path, batch_lines=256, mode="a", atomic=False):
+        self.file_path = file_path
+        self.batch_lines = batch_lines
+        self.buffer = []
+        self.tmp_path = None
+        if mode == "a":
+            _repair_tail(file_path)
+            self.file = open(file_path, "ab")
+        elif atomic:
+            self.tmp_path = f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            self.file = open(self.tmp_path, "wb")
+        else:
+            self.file = open(file_path, "wb")
+
+    def write(self, line):
+        self.buffer.append(dumps(line) + b"\n")
+        if len(self.buffer) >= self.batch_lines:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.file.write(b"".join(self.buffer))
+            self.buffer = []
+        self.file.flush()
+
+    def close(self, commit=True):
+        self.flush()
+        self.file.close()
+        if self.tmp_path is not None:
+            if commit:
+                os.replace(self.tmp_path, self.file_path)
+            elif os.path.exists(self.tmp_path):
+                os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        # 出错时不替换原文件
+        self.close(commit=exc_type is None)
+
+
+_STOP = object()
+
+
+class JsonlAppender:
+    """后台单线程追加写 jsonl，每 flush_lines 行或 flush_interval 秒刷新一次"""
+
+    def __init__(self, file_path, flush_lines=32, flush_interval=5.0):
+        self.file_path = file_path
+        self.flush_lines = flush_lines
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def write(self, line):
+        self.queue.put(line)
+
+    def close(self):
+        self.queue.put(_STOP)
+        self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _run(self):
+        writer = JsonlWriter(self.file_path, batch_lines=self.flush_lines)
+        last_flush = time.monotonic()
+        while True:
+            try:
+                line = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                line = None
+            if line is _STOP:
+                break
+            if line is not None:
+                writer.write(line)
+            if time.monotonic() - last_flush >= self.flush_interval:
+                writer.flush()
+                last_flush = time.monotonic()
+        writer.close()
 
 
 def create_logger(log_file="./logs/download.log"):
@@ -47,17 +229,37 @@ def create_logger(log_file="./logs/download.log"):
     )
 
 
-def retry(retry_times, default=None):
+def retry(retry_times, default=None, delay=30, backoff=1):
     def decorator(func):
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
-            for _ in range(retry_times):
+            for i in range(retry_times):
                 try:
                     output = func(*args, **kwargs)
                     return output if output is not None else default
                 except Exception as e:
                     logger.warning(f"Function execution failed, retrying... {e}")
-                    time.sleep(30)
+                    metrics.count("retries", func=func.__name__)
+                    time.sleep(delay * backoff**i)
+
+            raise Exception("Function execution failed after multiple retries.")
+
+        return wrapper
+
+    return decorator
+
+
+def async_retry(retry_times, delay=1, backoff=2):
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            for i in range(retry_times):
+                try:
+                    return await func(*args, **kwargs)
+                except Exception as e:
+                    logger.warning(f"Function execution failed, retrying... {e}")
+                    metrics.count("retries", func=func.__name__)
+                    await asyncio.sleep(delay * backoff**i)
 
             raise Exception("Function execution failed after multiple retries.")
 
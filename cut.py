@@ -1,90 +1,133 @@
 import argparse
 import os
 import subprocess
-import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from loguru import logger
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.common.by import By
+from selenium.common.exceptions import TimeoutException
 
-from common import create_logger, read_jsonl, retry
+import metrics
+from browser import START_POINT_SELECTOR, BrowserPool
+from catalog import Catalog
+from common import create_logger, retry
+from media import get_duration
 
 
 def get_args():
     parser = argparse.ArgumentParser()
-    parser.add_argument("--record_files", type=str, default="./config/records.jsonl")
+    parser.add_argument(
+        "--record_files", type=str, default="./config/records.jsonl", help="导入到目录中的记录"
+    )
+    parser.add_argument("--catalog", type=str, default="./config/catalog.sqlite")
     parser.add_argument("--video_dir", type=str, default="videos")
     parser.add_argument("--output_dir", type=str, default="cut_videos")
+    parser.add_argument("--browsers", type=int, default=4, help="同时打开的浏览器数量")
+    parser.add_argument("--workers", type=int, default=4, help="同时运行的 ffmpeg 进程数量")
     args = parser.parse_args()
     return args
 
 @retry(5)
-def get_start_point(video_url):
-    # 创建Chrome浏览器选项
-    chrome_options = Options()
-    chrome_options.add_argument("--headless")  # 无界面模式
-
-    # 创建Chrome浏览器驱动
-    driver = webdriver.Chrome(options=chrome_options)
-
-    # 打开网页
-    driver.get(video_url)
-    # 等待网页加载完成
-    time.sleep(15)
-    logger.info(f"打开网页 {video_url}")
-
-    # 获取播放列表长度
-    try:
-        icon_list_selector = "#bilibili-player > div > div > div.bpx-player-primary-area > div.bpx-player-video-area > div.bpx-player-control-wrap > div.bpx-player-control-entity > div.bpx-player-control-top > div > div.bpx-player-progress-freezone"
-        icon_list = driver.find_element(By.CSS_SELECTOR, icon_list_selector)
-        # 查找icon_list中第一个子元素的img标签的data-seek属性
-        icon_list = icon_list.find_element(By.TAG_NAME, "img")
-        start_point = icon_list.get_attribute("data-seek")
-        start_point = int(start_point)
-    except:
-        start_point = 0
-        logger.warning(f"获取视频 {video_url} 的开始时间失败")
-
-    # 关闭浏览器
-    driver.quit()
+@metrics.span("browser.start_point")
+def get_start_point(pool: BrowserPool, video_url):
+    with pool.driver() as driver:
+        # 打开网页并等待进度条上的图标加载完成
+        try:
+            icon = pool.open(driver, video_url, START_POINT_SELECTOR)
+            logger.info(f"打开网页 {video_url}")
+            # 查找icon_list中第一个子元素的img标签的data-seek属性
+            start_point = int(icon.get_attribute("data-seek"))
+        except (TimeoutException, TypeError, ValueError):
+            start_point = 0
+            logger.warning(f"获取视频 {video_url} 的开始时间失败")
 
     return start_point
 
 def cut_video(input_file, output_file, start_time):
-    # 使用ffmpeg命令行工具剪切视频
-    subprocess.run(['ffmpeg', '-ss', start_time, '-i', input_file, '-c', 'copy', output_file])
+    # 使用ffmpeg命令行工具剪切视频，先写入临时文件，完成后再替换，中断时不会留下半个视频
+    output_dir, file_name = os.path.split(output_file)
+    tmp_file = os.path.join(output_dir, f".{file_name}.tmp.mp4")
+    try:
+        with metrics.span("cut_video"):
+            subprocess.run(
+                ['ffmpeg', '-y', '-loglevel', 'error', '-ss', start_time, '-i', input_file,
+                 '-c', 'copy', tmp_file],
+                check=True,
+            )
+        metrics.observe("cut_video_bytes", os.path.getsize(tmp_file))
+        os.replace(tmp_file, output_file)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+
+def get_start_points(catalog: Catalog, parts: list, browsers: int) -> list:
+    """优先使用目录中记录的开始时间，只对缺失的分P打开浏览器获取"""
+    start_points = [
+        catalog.get_start_point(name, part_url, record) for name, part_url, record in parts
+    ]
+    missing = [i for i, start_point in enumerate(start_points) if start_point is None]
+    logger.info(f"{len(parts) - len(missing)} 个分P已有开始时间，{len(missing)} 个需要获取")
+    if missing:
+        # 复用浏览器并发获取所有缺失的开始时间
+        with BrowserPool(size=browsers) as pool:
+            scraped = pool.map(get_start_point, [parts[i][1] for i in missing])
+        for i, start_point in zip(missing, scraped):
+            start_points[i] = start_point
+            # 获取失败的 0 不写入目录，下次重新获取
+            if start_point:
+                catalog.set_start_point(parts[i][0], start_point)
+    return start_points
+
+
+def cut_part(name, input_file, output_file, start_point):
+    if not os.path.exists(input_file):
+        logger.warning(f"{name} 的开始时间为{start_point}，该文件不存在，跳过")
+        return False
+    if start_point >= get_duration(input_file):
+        logger.warning(f"{name} 的开始时间{start_point}超过视频时长，跳过")
+        return False
+    cut_video(input_file, output_file, str(start_point))
+    return True
 
 
 def main():
     args = get_args()
-    records = read_jsonl(args.record_files)
-    records = [record for record in records if record["playlist_idx"]]
+    catalog = Catalog(args.catalog)
+    catalog.import_jsonl(args.record_files)
     if not os.path.exists(args.output_dir):
         os.mkdir(args.output_dir)
-    for record in records:
-        video_url = record["url"]
-        for idx, p_idx in enumerate(record["playlist_idx"]):
-            teams = record["teams"]
-            date = record["date"]
-            teams = "_".join(teams)
-            input_file = os.path.join(args.video_dir, f"{teams}_{date}_{idx + 1}.mp4")
-            output_file = os.path.join(args.output_dir, f"{teams}_{date}_{idx + 1}.mp4")
-            if os.path.exists(output_file):
-                logger.info(f"{output_file} 已存在")
-                continue
-
-            start_point = get_start_point(video_url + f"?p={p_idx}")
-            logger.info(f"{teams}_{date}_{idx + 1} 的开始时间为{start_point}")
-
-            if not os.path.exists(input_file):
-                logger.warning(f"{teams}_{date}_{idx + 1} 的开始时间为{start_point}，该文件不存在，跳过")
-                continue
-
-            cut_video(input_file, output_file, str(start_point))
-            time.sleep(30)
+    parts = []
+    for name, part_url, record in catalog.parts():
+        output_file = os.path.join(args.output_dir, f"{name}.mp4")
+        if os.path.exists(output_file):
+            logger.info(f"{output_file} 已存在")
+            catalog.set_status(name, "cut")
+            continue
+        parts.append((name, part_url, record))
+
+    start_points = get_start_points(catalog, parts, args.browsers)
+
+    # 流复制主要受磁盘限制，多个 ffmpeg 并发运行
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = {}
+        for (name, _, _), start_point in zip(parts, start_points):
+            input_file = os.path.join(args.video_dir, f"{name}.mp4")
+            output_file = os.path.join(args.output_dir, f"{name}.mp4")
+            logger.info(f"{name} 的开始时间为{start_point}")
+            future = executor.submit(cut_part, name, input_file, output_file, start_point)
+            futures[future] = name
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                if future.result():
+                    catalog.set_status(name, "cut")
+            except subprocess.CalledProcessError as e:
+                logger.error(f"剪切 {name} 失败: {e}")
+                catalog.set_status(name, "cut", "failed")
+    catalog.close()
 
 
 if __name__ == "__main__":
     create_logger("./logs/cut.log")
+    metrics.init("cut")
     main()
\ No newline at end of file
@@ -1,37 +1,83 @@
 import argparse
-import json
 import os
 import re
 import shutil
 import subprocess
-import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 
 from loguru import logger
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.common.by import By
 from tqdm import tqdm
 
-from common import create_logger, retry
+import bilibili
+import metrics
+from browser import PLAYLIST_SELECTOR, START_POINT_SELECTOR, BrowserPool
+from catalog import Catalog, get_part_name
+from common import create_logger, read_json, retry
+from ratelimit import HostRateLimiter
 
 
 def get_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser()
     parser.add_argument("--video_list", type=str, default="video_list.json")
-    parser.add_argument("--record_file", type=str, default="./config/records.jsonl")
+    parser.add_argument(
+        "--record_file",
+        type=str,
+        default="./config/records.jsonl",
+        help="启动时导入目录，结束后导出为 jsonl",
+    )
+    parser.add_argument("--catalog", type=str, default="./config/catalog.sqlite")
     parser.add_argument("--output_dir", type=str, default="videos")
+    parser.add_argument(
+        "--metadata",
+        type=str,
+        default="http",
+        choices=["http", "browser"],
+        help="http: 直接请求 B 站接口; browser: 使用无界面浏览器解析网页",
+    )
+    parser.add_argument("--browsers", type=int, default=4, help="同时打开的浏览器数量")
+    parser.add_argument("--metadata_workers", type=int, default=8, help="http 模式的并发请求数")
+    parser.add_argument("--download_workers", type=int, default=4, help="同时下载的分P数量")
+    parser.add_argument(
+        "--host_rate", type=float, default=0.2, help="每个域名每秒最多开始的下载数"
+    )
     return parser.parse_args()
 
 
-@retry(retry_times=5)
-def download(video_url: str, file_name: str, output_dir: str):
+@retry(retry_times=5, delay=5, backoff=2)
+def download(
+    video_url: str, file_name: str, output_dir: str, limiter: HostRateLimiter = None
+):
     you_get_path = shutil.which("you-get")
     if you_get_path is None:
         raise FileNotFoundError("you-get not found.")
-
-    command = f"{you_get_path} --format=dash-flv480 --no-caption --output-filename {file_name} --output-dir {output_dir} {video_url}"
-    subprocess.run(command, shell=True, check=True)
+    if limiter is not None:
+        limiter.acquire(video_url)
+
+    # 先下载到临时目录，you-get 会从其中的 .download 文件续传
+    partial_dir = os.path.join(output_dir, ".partial", file_name)
+    os.makedirs(partial_dir, exist_ok=True)
+    command = [
+        you_get_path,
+        "--format=dash-flv480",
+        "--no-caption",
+        "--output-filename",
+        file_name,
+        "--output-dir",
+        partial_dir,
+        video_url,
+    ]
+    with metrics.span("download"):
+        subprocess.run(command, check=True)
+
+    # 下载完整后再重命名到输出目录，中断时不会留下被当作已完成的半个 mp4
+    partial_file = os.path.join(partial_dir, f"{file_name}.mp4")
+    if not os.path.exists(partial_file):
+        raise FileNotFoundError(f"{partial_file} not found after download.")
+    metrics.observe("download_bytes", os.path.getsize(partial_file))
+    os.replace(partial_file, os.path.join(output_dir, f"{file_name}.mp4"))
+    shutil.rmtree(partial_dir, ignore_errors=True)
 
 
 def extract_teams_and_date(text):
@@ -58,107 +104,143 @@ def has_match(string: str) -> bool:
     return bool(match)
 
 
-def get_video_info(video_url: str):
-    # 创建Chrome浏览器选项
-    chrome_options = Options()
-    chrome_options.add_argument("--headless")  # 无界面模式
+@retry(retry_times=3)
+@metrics.span("browser.video_info")
+def get_video_info(pool: BrowserPool, video_url: str):
+    with pool.driver() as driver:
+        # 打开网页
+        driver.get(video_url)
+
+        # 获取网页标题
+        title = driver.title
+        if "_" in title:
+            title = title.split("_")[0]
+        teams, date = extract_teams_and_date(title)
+        if not teams:
+            logger.info(f"视频{title}不是比赛视频，URL为{video_url}")
+            return None, None, None, None
+
+        # 等待播放列表加载完成，获取播放列表长度
+        playlist = pool.wait(driver, PLAYLIST_SELECTOR)
+        # 遍历playlist，获取最大的数字
+        playlist_idx = []
+        for idx, li in enumerate(playlist.find_elements(By.TAG_NAME, "li")):
+            text = li.text
+            if has_match(text):
+                playlist_idx.append(idx + 1)
+
+        # 等待进度条上的图标加载完成，查找第一个img标签的data-seek属性
+        icon = pool.wait(driver, START_POINT_SELECTOR)
+        start_point = int(icon.get_attribute("data-seek"))
+
+    return teams, date, playlist_idx, start_point
 
-    # 创建Chrome浏览器驱动
-    driver = webdriver.Chrome(options=chrome_options)
 
-    # 打开网页
-    driver.get(video_url)
-    # 等待网页加载完成
-    time.sleep(10)
+@retry(retry_times=3)
+def get_video_info_http(video_url: str):
+    bvid = bilibili.get_bvid(video_url)
+    view = bilibili.get_view(bvid)
 
-    # 获取网页标题
-    title = driver.title
-    if "_" in title:
-        title = title.split("_")[0]
+    # 标题中包含日期和队伍
+    title = view["title"]
     teams, date = extract_teams_and_date(title)
     if not teams:
         logger.info(f"视频{title}不是比赛视频，URL为{video_url}")
         return None, None, None, None
 
-    # 获取播放列表长度
-    playlist_path = "#multi_page > div.cur-list > ul"
-    playlist = driver.find_element(By.CSS_SELECTOR, playlist_path)
-    # 遍历playlist，获取最大的数字
-    playlist_idx = []
-    for idx, li in enumerate(playlist.find_elements(By.TAG_NAME, "li")):
-        text = li.text
-        if has_match(text):
-            playlist_idx.append(idx + 1)
-
-    icon_list_selector = "#bilibili-player > div > div > div.bpx-player-primary-area > div.bpx-player-video-area > div.bpx-player-control-wrap > div.bpx-player-control-entity > div.bpx-player-control-top > div > div.bpx-player-progress-freezone"
-    icon_list = driver.find_element(By.CSS_SELECTOR, icon_list_selector)
-    # 查找icon_list中第一个子元素的img标签的data-seek属性
-    icon_list = icon_list.find_element(By.TAG_NAME, "img")
-    start_point = icon_list.get_attribute("data-seek")
-    start_point = int(start_point)
-    # 关闭浏览器
-    driver.quit()
+    # 分P列表
+    playlist_idx = [
+        idx + 1 for idx, page in enumerate(view["pages"]) if has_match(page["part"])
+    ]
+
+    # 与网页一致，取第一个分P进度条上的看点时间
+    start_point = bilibili.get_start_point(view["pages"][0]["cid"], view["aid"], bvid)
 
     return teams, date, playlist_idx, start_point
 
 
 def main():
     create_logger()
+    metrics.init("download")
     args = get_args()
     logger.debug(args)
 
-    with open(args.video_list, "r") as f:
-        video_list = json.load(f)
-
-    with open(args.record_file, "a+") as f:
-        f.seek(0)
-        records = [json.loads(line) for line in f]
-        f.seek(0, 2)
-        for video_url in tqdm(video_list):
-            if any([video_url == record["url"] for record in records]):
-                logger.info(f"视频{video_url}元信息已获取")
-                record = [record for record in records if record["url"] == video_url][0]
-                record["start_point"] = record["start_point"] if "start_point" in record else None
-                teams, date, playlist_idx, start_point = record["teams"], record["date"], record["playlist_idx"], record["start_point"]
-            else:
-                teams, date, playlist_idx, start_point = get_video_info(video_url)
-                if teams is not None:
-                    records.append(
-                        {
-                            "teams": teams,
-                            "date": date,
-                            "playlist_idx": playlist_idx,
-                            "url": video_url,
-                            "start_point": start_point,
-                        }
-                    )
-                    f.write(
-                        json.dumps(
-                            {
-                                "url": video_url,
-                                "teams": teams,
-                                "date": date,
-                                "playlist_idx": playlist_idx,
-                                "start_point": start_point,
-                            }
-                        )
-                        + "\n"
-                    )
-                    f.flush()
-            if teams is not None:
-                logger.info(
-                    f"获取到了{teams[0]} vs {teams[1]} {date} {len(playlist_idx)}P的比赛视频"
+    video_list = read_json(args.video_list)
+
+    catalog = Catalog(args.catalog)
+    catalog.import_jsonl(args.record_file)
+
+    # 并发获取所有新视频的元信息
+    new_urls = [url for url in video_list if catalog.get(url) is None]
+    browsers = BrowserPool(size=args.browsers) if args.metadata == "browser" else None
+    workers = args.browsers if browsers is not None else args.metadata_workers
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {}
+            for video_url in new_urls:
+                if browsers is None:
+                    future = executor.submit(get_video_info_http, video_url)
+                else:
+                    future = executor.submit(get_video_info, browsers, video_url)
+                futures[future] = video_url
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Metadata"):
+                video_url = futures[future]
+                try:
+                    teams, date, playlist_idx, start_point = future.result()
+                except Exception as e:
+                    logger.error(f"获取{video_url}的信息失败: {e}")
+                    continue
+                # 获取到一个就写入目录，个别视频失败不影响其他视频
+                catalog.upsert(
+                    {
+                        "url": video_url,
+                        "teams": teams,
+                        "date": date,
+                        "playlist_idx": playlist_idx,
+                        "start_point": start_point,
+                    }
                 )
-
-                file_name = f"{teams[0]}_{teams[1]}_{date}"
-                for idx, i in enumerate(playlist_idx):
-                    if os.path.exists(f"{args.output_dir}/{file_name}_{idx + 1}.mp4"):
-                        logger.info(f"视频{file_name}_{idx + 1}已经存在，跳过")
-                        continue
-                    sub_file_name = f"{file_name}_{idx + 1}"
-                    logger.info(f"开始下载{sub_file_name}")
-                    download(video_url + f"?p={i}", sub_file_name, args.output_dir)
-                    time.sleep(15)
+    finally:
+        if browsers is not None:
+            browsers.close()
+    catalog.export_jsonl(args.record_file)
+
+    parts = []
+    for video_url in tqdm(video_list):
+        record = catalog.get(video_url)
+        if record is None or not record["teams"] or not record["playlist_idx"]:
+            continue
+        teams, date, playlist_idx = record["teams"], record["date"], record["playlist_idx"]
+        logger.info(
+            f"获取到了{teams[0]} vs {teams[1]} {date} {len(playlist_idx)}P的比赛视频"
+        )
+        for idx, i in enumerate(playlist_idx):
+            sub_file_name = get_part_name(record, idx)
+            if os.path.exists(f"{args.output_dir}/{sub_file_name}.mp4"):
+                logger.info(f"视频{sub_file_name}已经存在，跳过")
+                catalog.set_status(sub_file_name, "download")
+                continue
+            parts.append((video_url + f"?p={i}", sub_file_name))
+
+    # 并发下载所有分P，按域名限制开始下载的频率
+    limiter = HostRateLimiter(args.host_rate)
+    with ThreadPoolExecutor(max_workers=args.download_workers) as executor:
+        futures = {}
+        for part_url, sub_file_name in parts:
+            logger.info(f"加入下载队列{sub_file_name}")
+            future = executor.submit(
+                download, part_url, sub_file_name, args.output_dir, limiter
+            )
+            futures[future] = sub_file_name
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Download"):
+            try:
+                future.result()
+                logger.info(f"{futures[future]}下载完成")
+                catalog.set_status(futures[future], "download")
+            except Exception as e:
+                logger.error(f"{futures[future]}下载失败: {e}")
+                catalog.set_status(futures[future], "download", "failed")
+    catalog.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,293 @@
+"""
+@File    :   export.py
+@Time    :   2023/12/25 10:21:37
+@Author  :   TankNee
+@Version :   1.0
+@Desc    :   把片段、关键帧、字幕和润色后的字幕打包为 WebDataset 格式的 tar 分片，并生成可 mmap 的索引
+"""
+
+import argparse
+import glob
+import io
+import os
+import re
+import tarfile
+from multiprocessing import Pool
+
+import numpy as np
+from loguru import logger
+from tqdm import tqdm
+
+import metrics
+from common import create_logger, dumps, iter_jsonl
+from extract import get_video_name, list_keyframes, load_done_videos
+
+# 每个样本在索引中占一行，key 定长以便 mmap 后直接二分查找
+INDEX_DTYPE = np.dtype(
+    [("key", "S128"), ("shard", "<u4"), ("offset", "<u8"), ("size", "<u8")]
+)
+INDEX_PATTERN = re.compile(r"shard-(\d{6})\.index\.npy$")
+TAR_BLOCK = 512
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--split_dir",
+        type=str,
+        default="/new_disk/cv_group/tanknee/Data/lpl-gpt/2023-spring-split",
+        help="split.py 的输出目录，读取其中的 manifest.jsonl 和 keyframes",
+    )
+    parser.add_argument(
+        "--results", type=str, default="outputs/results.jsonl", help="refine.py 的输出"
+    )
+    parser.add_argument(
+        "--output_dir",
+        type=str,
+        default="/new_disk/cv_group/tanknee/Data/lpl-gpt/2023-spring-shards",
+    )
+    parser.add_argument("--shard_size_mb", type=int, default=1024, help="每个分片的目标大小")
+    parser.add_argument("--workers", type=int, default=8, help="同时写入的分片数")
+    parser.add_argument(
+        "--partial",
+        action="store_true",
+        help="导出缺少关键帧或润色结果的片段，默认只导出完整的片段，分片写入后不会再修改",
+    )
+    parser.add_argument(
+        "--num_key_frames",
+        type=int,
+        default=15,
+        help="与 extract.py 一致，清单中没有记录的旧输出关键帧数量达到它才算完成",
+    )
+    return parser.parse_args()
+
+
+def get_sample_key(name: str) -> str:
+    # WebDataset 以文件名中第一个点之前的部分作为样本 key，片段名中的时间带有小数点
+    return name.replace(".", "-")
+
+
+def get_shard_path(output_dir: str, shard: int, suffix: str = ".tar") -> str:
+    return os.path.join(output_dir, f"shard-{shard:06d}{suffix}")
+
+
+def tar_size(size: int) -> int:
+    # 一个成员在 tar 中占用的字节数：文件头加上补齐到块大小的内容
+    return TAR_BLOCK + (size + TAR_BLOCK - 1) // TAR_BLOCK * TAR_BLOCK
+
+
+def load_refined(results_path: str) -> dict:
+    # 以字幕文件名对应片段，与 refine.py 使用的目录无关
+    if not os.path.exists(results_path):
+        return {}
+    return {
+        get_video_name(record["subtitle_path"]): record["refined_subtitle"]
+        for record in iter_jsonl(results_path)
+    }
+
+
+def load_exported(output_dir: str) -> (set, int):
+    # 只有写完索引的分片才算完成，返回已导出的样本和下一个分片编号
+    exported = set()
+    next_shard = 0
+    for index_path in glob.glob(os.path.join(output_dir, "shard-*.index.npy")):
+        index = np.load(index_path, mmap_mode="r")
+        exported.update(key.decode("utf-8") for key in index["key"])
+        shard = int(INDEX_PATTERN.match(os.path.basename(index_path)).group(1))
+        next_shard = max(next_shard, shard + 1)
+    return exported, next_shard
+
+
+def collect_samples(
+    split_dir: str, refined: dict, exported: set, partial: bool, num_key_frames: int = 15
+) -> list:
+    keyframe_dir = os.path.join(split_dir, "keyframes")
+    keyframes = list_keyframes(keyframe_dir) if os.path.exists(keyframe_dir) else {}
+    # 只有清单记为 done 的片段关键帧才完整，失败、不完整或正在提取的片段不能写进分片
+    done = load_done_videos(
+        split_dir,
+        {name: len(idx_list) for name, idx_list in keyframes.items()},
+        num_key_frames,
+    )
+    samples = []
+    skipped = 0
+    for clip in iter_jsonl(os.path.join(split_dir, "manifest.jsonl")):
+        name = get_video_name(clip["video_path"])
+        key = get_sample_key(name)
+        if len(key.encode("utf-8")) > INDEX_DTYPE["key"].itemsize:
+            raise ValueError(f"Clip name {name} is too long for the index")
+        if key in exported:
+            continue
+        if not os.path.exists(clip["video_path"]) or not os.path.exists(
+            clip["subtitle_path"]
+        ):
+            skipped += 1
+            continue
+        if not partial and (name not in done or name not in refined):
+            # 还没提取完关键帧或润色的片段留到下次导出
+            skipped += 1
+            continue
+        # 按实际存在的文件列出，分片中重新从 0 连续编号
+        idx_list = keyframes.get(name, [])
+        num_keyframes = len(idx_list)
+        members = [(f"{key}.mp4", clip["video_path"])]
+        members += [
+            (f"{key}.{i}.jpeg", os.path.join(keyframe_dir, f"{name}_{idx}.jpeg"))
+            for i, idx in enumerate(idx_list)
+        ]
+        members.append((f"{key}.subtitle.json", clip["subtitle_path"]))
+        meta = {
+            "name": name,
+            "num_keyframes": num_keyframes,
+            "refined_subtitle": refined.get(name),
+        }
+        size = sum(tar_size(os.path.getsize(path)) for _, path in members)
+        samples.append({"key": key, "members": members, "meta": meta, "size": size})
+    logger.info(f"{len(samples)} clips to export, {skipped} clips not ready")
+    return samples
+
+
+def plan_shards(samples: list, shard_size: int, first_shard: int) -> list:
+    # 按清单顺序依次装入分片，单个样本超过目标大小时独占一个分片
+    shards = []
+    current, current_size = [], 0
+    for sample in samples:
+        if current and current_size + sample["size"] > shard_size:
+            shards.append(current)
+            current, current_size = [], 0
+        current.append(sample)
+        current_size += sample["size"]
+    if current:
+        shards.append(current)
+    return [(first_shard + i, shard) for i, shard in enumerate(shards)]
+
+
+def _add_bytes(tar: tarfile.TarFile, name: str, data: bytes, mtime: int):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = mtime
+    info.mode = 0o644
+    tar.addfile(info, io.BytesIO(data))
+
+
+def _add_file(tar: tarfile.TarFile, name: str, path: str):
+    stat = os.stat(path)
+    info = tarfile.TarInfo(name)
+    info.size = stat.st_size
+    # 整数时间不会产生额外的 pax 头
+    info.mtime = int(stat.st_mtime)
+    info.mode = 0o644
+    with open(path, "rb") as f:
+        tar.addfile(info, f)
+
+
+def write_shard(output_dir: str, shard: int, samples: list) -> (int, int):
+    """写入一个分片和它的索引，先写临时文件，索引写完才算完成"""
+    tar_path = get_shard_path(output_dir, shard)
+    index_path = get_shard_path(output_dir, shard, ".index.npy")
+    index = np.zeros(len(samples), dtype=INDEX_DTYPE)
+    with metrics.span("export_shard"):
+        with open(tar_path + ".tmp", "wb") as f, tarfile.open(fileobj=f, mode="w") as tar:
+            for i, sample in enumerate(samples):
+                start = tar.offset
+                for name, path in sample["members"]:
+                    _add_file(tar, name, path)
+                mtime = int(os.path.getmtime(sample["members"][0][1]))
+                _add_bytes(tar, f"{sample['key']}.json", dumps(sample["meta"]), mtime)
+                index[i] = (sample["key"].encode("utf-8"), shard, start, tar.offset - start)
+        os.replace(tar_path + ".tmp", tar_path)
+        with open(index_path + ".tmp", "wb") as f:
+            np.save(f, index)
+        os.replace(index_path + ".tmp", index_path)
+    size = os.path.getsize(tar_path)
+    metrics.observe("shard_bytes", size)
+    metrics.count("exported_samples", len(samples))
+    return shard, size
+
+
+def _write_shard_task(task):
+    return write_shard(*task)
+
+
+def merge_index(output_dir: str) -> int:
+    """把所有分片的索引合并为按 key 排序的 index.npy，返回样本总数"""
+    indices = [
+        np.load(path)
+        for path in sorted(glob.glob(os.path.join(output_dir, "shard-*.index.npy")))
+    ]
+    index = np.concatenate(indices) if indices else np.zeros(0, dtype=INDEX_DTYPE)
+    index = index[np.argsort(index["key"], kind="stable")]
+    index_path = os.path.join(output_dir, "index.npy")
+    with open(index_path + ".tmp", "wb") as f:
+        np.save(f, index)
+    os.replace(index_path + ".tmp", index_path)
+    return len(index)
+
+
+class ShardIndex:
+    """以 mmap 打开合并后的索引，按片段名随机读取样本"""
+
+    def __init__(self, output_dir: str):
+        self.output_dir = output_dir
+        self.index = np.load(os.path.join(output_dir, "index.npy"), mmap_mode="r")
+
+    def __len__(self):
+        return len(self.index)
+
+    def locate(self, name: str) -> (str, int, int):
+        key = get_sample_key(name).encode("utf-8")
+        idx = int(np.searchsorted(self.index["key"], key))
+        if idx == len(self.index) or self.index["key"][idx] != key:
+            raise KeyError(name)
+        row = self.index[idx]
+        return (
+            get_shard_path(self.output_dir, int(row["shard"])),
+            int(row["offset"]),
+            int(row["size"]),
+        )
+
+    def read(self, name: str) -> dict:
+        # 返回 {扩展名: 内容}，例如 mp4、0.jpeg、subtitle.json、json
+        shard_path, offset, size = self.locate(name)
+        with open(shard_path, "rb") as f:
+            f.seek(offset)
+            data = f.read(size)
+        sample = {}
+        with tarfile.open(fileobj=io.BytesIO(data), mode="r:") as tar:
+            for member in tar:
+                suffix = member.name.split(".", 1)[1]
+                sample[suffix] = tar.extractfile(member).read()
+        return sample
+
+
+def main():
+    create_logger("./logs/export.log")
+    metrics.init("export")
+    args = get_args()
+    os.makedirs(args.output_dir, exist_ok=True)
+    # 上次中断时留下的临时文件
+    for tmp_path in glob.glob(os.path.join(args.output_dir, "*.tmp")):
+        os.remove(tmp_path)
+
+    exported, next_shard = load_exported(args.output_dir)
+    refined = load_refined(args.results)
+    samples = collect_samples(
+        args.split_dir, refined, exported, args.partial, args.num_key_frames
+    )
+    shards = plan_shards(samples, args.shard_size_mb << 20, next_shard)
+    logger.info(
+        f"{len(exported)} clips already exported, "
+        f"writing {len(samples)} clips into {len(shards)} new shards"
+    )
+
+    tasks = [(args.output_dir, shard, shard_samples) for shard, shard_samples in shards]
+    with Pool(args.workers) as pool:
+        for shard, size in tqdm(
+            pool.imap_unordered(_write_shard_task, tasks), total=len(tasks)
+        ):
+            logger.info(f"Write {get_shard_path(args.output_dir, shard)} ({size >> 20} MB)")
+    logger.info(f"Index {merge_index(args.output_dir)} clips in total")
+
+
+if __name__ == "__main__":
+    main()
@@ -8,58 +8,221 @@
 
 import argparse
 import glob
-from multiprocessing import Pool
 import os
-import sys
+import zlib
+from multiprocessing import Pool
 
 from loguru import logger
-from moviepy.editor import VideoFileClip
 from tqdm import tqdm
-from Katna.video import Video
-from Katna.writer import KeyFrameDiskWriter
 
-from common import create_logger
+import metrics
+from common import JsonlWriter, create_logger, iter_jsonl
+from keyframe import extract_video_keyframes
+from media import probe_media
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--split_video_dir",
+        type=str,
+        default="/new_disk/cv_group/tanknee/Data/lpl-gpt/2023-spring-split/videos",
+        help="切分后的视频片段目录",
+    )
+    parser.add_argument(
+        "--output_dir",
+        type=str,
+        default="/new_disk/cv_group/tanknee/Data/lpl-gpt/2023-spring-split",
+        help="关键帧输出目录",
+    )
+    parser.add_argument("--num_key_frames", type=int, default=15)
+    parser.add_argument(
+        "--engine",
+        type=str,
+        default="native",
+        choices=["native", "katna"],
+        help="native: 内置的 ffmpeg + NumPy 关键帧提取; katna: 原来的 Katna 实现",
+    )
+    parser.add_argument("--shard_index", "--shard-index", type=int, default=0)
+    parser.add_argument("--num_shards", "--num-shards", type=int, default=1)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    return parser.parse_args()
+
+
+def get_video_name(video_path: str) -> str:
+    return ".".join(os.path.basename(video_path).split(".")[:-1])
+
+
+def in_shard(video_path: str, shard_index: int, num_shards: int) -> bool:
+    # 按文件名哈希分片，新增视频不会改变已有视频所属的分片
+    video_name = get_video_name(video_path)
+    return zlib.crc32(video_name.encode("utf-8")) % num_shards == shard_index
+
+
+def get_manifest_path(output_dir: str, shard_index: int, num_shards: int) -> str:
+    return os.path.join(
+        output_dir, "keyframes_manifest", f"shard-{shard_index}-of-{num_shards}.jsonl"
+    )
+
 
-args = {
-    "split_video_dir": "/new_disk/cv_group/tanknee/Data/lpl-gpt/2023-spring-split/videos",
-    "output_dir": "/new_disk/cv_group/tanknee/Data/lpl-gpt/2023-spring-split",
-    # "split_video_dir": "/disk0/cv_group/tanknee/CodeRepo/LPL-GPT/outputs/videos",
-    # "output_dir": "/disk0/cv_group/tanknee/CodeRepo/LPL-GPT/outputs",
-    "num_key_frames": 15,
-}
+def load_done_videos(output_dir: str, counts: dict = None, num_key_frames: int = 0) -> set:
+    """读取所有分片的清单，调整分片数后已完成的视频也不会重做
+
+    只有 done 算完成，skipped 和 failed 的视频会重新提取。
+    counts 中关键帧已写满但清单里没有记录的视频（旧版本的输出）同样视为已完成
+    """
+    done, recorded = set(), set()
+    for manifest_path in glob.glob(
+        os.path.join(output_dir, "keyframes_manifest", "*.jsonl")
+    ):
+        for record in iter_jsonl(manifest_path):
+            recorded.add(record["video_name"])
+            if record["status"] == "done":
+                done.add(record["video_name"])
+    done.update(
+        name
+        for name, count in (counts or {}).items()
+        if count >= num_key_frames and name not in recorded
+    )
+    return done
+
+
+def list_keyframes(keyframe_dir: str) -> dict:
+    # 一次性列出目录中每个视频实际存在的关键帧编号，写出失败的帧会留下空缺
+    indices = {}
+    with os.scandir(keyframe_dir) as entries:
+        for entry in entries:
+            name, _, idx = entry.name[: -len(".jpeg")].rpartition("_")
+            if entry.name.endswith(".jpeg") and idx.isdigit():
+                indices.setdefault(name, []).append(int(idx))
+    for idx_list in indices.values():
+        idx_list.sort()
+    return indices
+
+
+def count_keyframes(keyframe_dir: str) -> dict:
+    # 一次性统计目录中每个视频已有的关键帧数量
+    return {name: len(idx_list) for name, idx_list in list_keyframes(keyframe_dir).items()}
+
+
+def remove_partial_keyframes(keyframe_dir: str, video_name: str, num_frames: int):
+    # 按编号逐个删除，不必列出整个关键帧目录
+    for i in range(num_frames):
+        try:
+            os.remove(os.path.join(keyframe_dir, f"{video_name}_{i}.jpeg"))
+        except FileNotFoundError:
+            pass
 
 
-args = argparse.Namespace(**args)
+def extract_keyframes(
+    video_path: str,
+    output_dir: str,
+    num_key_frames: int = 15,
+    engine: str = "native",
+    num_existing: int = 0,
+):
+    """num_existing 为目录中已有的该视频的关键帧数量，返回 (状态, 写出的关键帧数量)"""
+    keyframe_dir = os.path.join(output_dir, "keyframes")
+    video_name = get_video_name(video_path)
+    # 上次中断或失败时可能留下了一部分关键帧
+    remove_partial_keyframes(keyframe_dir, video_name, max(num_existing, num_key_frames))
+    try:
+        info = probe_media(video_path)
+    except Exception as e:
+        logger.warning(f"Cannot probe {video_path}, skip it: {e}")
+        return "skipped", 0
+    # 片段帧数少于关键帧数量时只取全部帧
+    num_frames = int(info["duration"] * info["fps"])
+    if num_frames <= 0:
+        logger.warning(f"Video {video_path} is empty, skip it")
+        return "skipped", 0
+    num_key_frames = min(num_key_frames, num_frames)
+    if engine == "native":
+        with metrics.span("extract_video_keyframes", engine=engine):
+            num_written = extract_video_keyframes(
+                video_path, keyframe_dir, num_key_frames, fps=info["fps"]
+            )
+    else:
+        from Katna.video import Video
+        from Katna.writer import KeyFrameDiskWriter
 
-def extract_keyframes(video_path: str):
-    if not os.path.exists(os.path.join(args.output_dir, "keyframes")):
-        os.makedirs(os.path.join(args.output_dir, "keyframes"))
-        logger.info(
-            f"Create keyframes directory in {os.path.join(args.output_dir, 'keyframes')}"
+        vd = Video(parallel=False, ordered=True)
+        writer = KeyFrameDiskWriter(location=keyframe_dir)
+        with metrics.span("extract_video_keyframes", engine=engine):
+            vd.extract_video_keyframes(
+                no_of_frames=num_key_frames,
+                file_path=video_path,
+                writer=writer,
+            )
+        num_written = sum(
+            os.path.exists(os.path.join(keyframe_dir, f"{video_name}_{i}.jpeg"))
+            for i in range(num_key_frames)
         )
-    video_name = ".".join(os.path.basename(video_path).split(".")[:-1])
-    if os.path.exists(os.path.join(args.output_dir, "keyframes", f"{video_name}_0.jpeg")):
-        return
-    vd = Video(parallel=False, ordered=True)
-    writer = KeyFrameDiskWriter(location=os.path.join(args.output_dir, "keyframes"))
-    vd.extract_video_keyframes(
-        no_of_frames=args.num_key_frames, file_path=video_path, writer=writer
+    metrics.count("keyframes", num_written)
+    if num_written != num_key_frames:
+        # 只写出一部分关键帧时记为失败，下次运行会重做
+        logger.warning(f"Only {num_written}/{num_key_frames} keyframes of {video_path}")
+        return "failed", num_written
+    return "done", num_written
+
+
+def _extract_task(task):
+    video_path, output_dir, num_key_frames, engine, num_existing = task
+    status, num_frames = extract_keyframes(
+        video_path, output_dir, num_key_frames, engine, num_existing
     )
+    return video_path, status, num_frames
 
 
 def main():
     create_logger("./logs/extract.log")
-    videos = glob.glob(os.path.join(args.split_video_dir, "*.mp4"))
-
-    logger.info(f"Extracting keyframes from {len(videos)} videos")
-    start_point = 0.7
-    end_point = 1.0
-    for i, video in enumerate(tqdm(videos)):
-        if i <= start_point * len(videos):
-            continue
-        if i >= end_point * len(videos):
-            break
-        extract_keyframes(video)
+    metrics.init("extract")
+    args = get_args()
+    keyframe_dir = os.path.join(args.output_dir, "keyframes")
+    if not os.path.exists(keyframe_dir):
+        os.makedirs(keyframe_dir, exist_ok=True)
+        logger.info(f"Create keyframes directory in {keyframe_dir}")
+    manifest_path = get_manifest_path(
+        args.output_dir, args.shard_index, args.num_shards
+    )
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+
+    videos = sorted(glob.glob(os.path.join(args.split_video_dir, "*.mp4")))
+    videos = [
+        video
+        for video in videos
+        if in_shard(video, args.shard_index, args.num_shards)
+    ]
+    counts = count_keyframes(keyframe_dir)
+    done = load_done_videos(args.output_dir, counts, args.num_key_frames)
+    todo = [video for video in videos if get_video_name(video) not in done]
+    logger.info(
+        f"Shard {args.shard_index}/{args.num_shards}: {len(videos)} videos, "
+        f"{len(videos) - len(todo)} done, extracting keyframes from {len(todo)} videos"
+    )
+
+    tasks = [
+        (
+            video,
+            args.output_dir,
+            args.num_key_frames,
+            args.engine,
+            counts.get(get_video_name(video), 0),
+        )
+        for video in todo
+    ]
+    # 只有主进程写清单，关键帧写完后才记录完成，中断时丢失的记录只会导致重做
+    with Pool(args.workers) as pool, JsonlWriter(manifest_path, batch_lines=32) as writer:
+        for video_path, status, num_frames in tqdm(
+            pool.imap_unordered(_extract_task, tasks), total=len(tasks)
+        ):
+            writer.write(
+                {
+                    "video_name": get_video_name(video_path),
+                    "status": status,
+                    "num_frames": num_frames,
+                }
+            )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,285 @@
+"""
+@File    :   keyframe.py
+@Time    :   2023/12/06 15:20:11
+@Author  :   TankNee
+@Version :   1.0
+@Desc    :   基于 ffmpeg 管道与 NumPy 的关键帧提取，输出格式与 Katna 的 KeyFrameDiskWriter 相同
+"""
+
+import bisect
+import os
+import shutil
+import subprocess
+import tempfile
+
+import numpy as np
+from loguru import logger
+
+from media import get_keyframes, probe_media
+
+# 打分时使用的缩略图尺寸与直方图分箱数
+THUMB_WIDTH = 96
+THUMB_HEIGHT = 54
+HIST_BINS = 16
+
+
+def read_thumbnails(
+    video_path: str,
+    batch_frames: int = 256,
+    threads: int = 1,
+    start: float = None,
+    end: float = None,
+    fps: float = None,
+):
+    """以低分辨率流式解码视频，每次产出形状为 (n, h, w, 3) 的 uint8 数组
+
+    start/end 只解码其中一段；指定 fps 时按固定帧率输出，第 i 帧的时间为 start + i / fps
+    """
+    frame_size = THUMB_WIDTH * THUMB_HEIGHT * 3
+    seek = []
+    if start:
+        seek += ["-ss", f"{start:.3f}"]
+    if end is not None:
+        seek += ["-t", f"{end - (start or 0):.3f}"]
+    scale = f"scale={THUMB_WIDTH}:{THUMB_HEIGHT}"
+    process = subprocess.Popen(
+        [
+            "ffmpeg",
+            "-v",
+            "error",
+            "-threads",
+            str(threads),
+            *seek,
+            "-i",
+            video_path,
+            "-an",
+            "-vf",
+            f"fps={fps},{scale}" if fps else scale,
+            "-pix_fmt",
+            "rgb24",
+            # 不让输出端复制或丢弃帧，第 i 个输出就是滤镜输出的第 i 帧
+            "-vsync",
+            "passthrough",
+            "-f",
+            "rawvideo",
+            "-",
+        ],
+        stdout=subprocess.PIPE,
+    )
+    try:
+        while True:
+            buffer = process.stdout.read(frame_size * batch_frames)
+            num_frames = len(buffer) // frame_size
+            if num_frames == 0:
+                break
+            yield np.frombuffer(buffer[: num_frames * frame_size], dtype=np.uint8).reshape(
+                num_frames, THUMB_HEIGHT, THUMB_WIDTH, 3
+            )
+    finally:
+        process.stdout.close()
+        process.wait()
+
+
+def color_histograms(frames: np.ndarray) -> np.ndarray:
+    """逐通道颜色直方图，返回 (n, 3 * HIST_BINS)，已按像素数归一化"""
+    num_frames = frames.shape[0]
+    bins = (frames >> (8 - int(np.log2(HIST_BINS)))).reshape(num_frames, -1, 3)
+    offsets = np.arange(3) * HIST_BINS + (np.arange(num_frames) * 3 * HIST_BINS)[:, None]
+    index = (bins + offsets[:, None, :]).ravel()
+    hist = np.bincount(index, minlength=num_frames * 3 * HIST_BINS)
+    return hist.reshape(num_frames, 3 * HIST_BINS) / bins.shape[1]
+
+
+def score_frames(video_path: str, threads: int = 1, **kwargs) -> np.ndarray:
+    """每一帧与前一帧的差异分数，由直方图距离和像素差组成，kwargs 传给 read_thumbnails"""
+    scores = []
+    prev_frame, prev_hist = None, None
+    for frames in read_thumbnails(video_path, threads=threads, **kwargs):
+        frames_f = frames.astype(np.float32)
+        hists = color_histograms(frames)
+        if prev_frame is None:
+            prev_frames = np.concatenate([frames_f[:1], frames_f[:-1]])
+            prev_hists = np.concatenate([hists[:1], hists[:-1]])
+        else:
+            prev_frames = np.concatenate([prev_frame[None], frames_f[:-1]])
+            prev_hists = np.concatenate([prev_hist[None], hists[:-1]])
+        hist_diff = 0.5 * np.abs(hists - prev_hists).sum(axis=1)
+        pixel_diff = np.abs(frames_f - prev_frames).mean(axis=(1, 2, 3)) / 255.0
+        scores.append(hist_diff + pixel_diff)
+        prev_frame, prev_hist = frames_f[-1], hists[-1]
+    if not scores:
+        return np.zeros(0, dtype=np.float32)
+    return np.concatenate(scores)
+
+
+def select_frames(scores: np.ndarray, num_key_frames: int) -> list:
+    """按分数从高到低挑选关键帧，相邻关键帧之间保持最小间隔，返回按时间排序的帧号"""
+    num_frames = len(scores)
+    num_key_frames = min(num_key_frames, num_frames)
+    if num_key_frames <= 0:
+        return []
+    min_gap = max(1, num_frames // (num_key_frames * 4))
+    selected = []
+    for idx in np.argsort(-scores, kind="stable"):
+        if scores[idx] <= 0:
+            break
+        if all(abs(int(idx) - s) >= min_gap for s in selected):
+            selected.append(int(idx))
+            if len(selected) == num_key_frames:
+                break
+    if len(selected) < num_key_frames:
+        # 画面变化太少时用均匀采样补齐
+        for idx in np.linspace(0, num_frames - 1, num_key_frames).astype(int).tolist():
+            if idx not in selected:
+                selected.append(idx)
+            if len(selected) == num_key_frames:
+                break
+    return sorted(selected)
+
+
+def write_frames(
+    video_path: str, frame_indices: list, output_dir: str, fps: float, threads: int = 1
+) -> int:
+    """只把选中的帧以原始分辨率写出，文件名为 {video_name}_{i}.jpeg，返回写出的数量"""
+    video_name = ".".join(os.path.basename(video_path).split(".")[:-1])
+    # 打分时按固定帧率解码，第 idx 帧的时间为 idx / fps
+    timestamps = [idx / fps for idx in frame_indices]
+    keyframes = get_keyframes(video_path)
+    return write_frames_at(
+        video_path, timestamps, output_dir, video_name, fps, keyframes, threads
+    )
+
+
+def extract_video_keyframes(
+    video_path: str,
+    output_dir: str,
+    num_key_frames: int = 15,
+    threads: int = 1,
+    fps: float = None,
+) -> int:
+    """返回写出的关键帧数量"""
+    if fps is None:
+        fps = probe_media(video_path)["fps"]
+    scores = score_frames(video_path, threads=threads, fps=fps)
+    frame_indices = select_frames(scores, num_key_frames)
+    if not frame_indices:
+        logger.warning(f"No frame decoded from {video_path}")
+        return 0
+    return write_frames(video_path, frame_indices, output_dir, fps, threads=threads)
+
+
+def group_by_gop(timestamps: list, keyframes: list, fps: float) -> list:
+    """按所在的 GOP 分组，返回 [(seek 位置, [时间点, ...]), ...]
+
+    同一个 GOP 内的帧从关键帧开始只解码一次；不同 GOP 分开 seek，不解码中间的帧
+    """
+    groups = {}
+    for timestamp in timestamps:
+        idx = bisect.bisect_right(keyframes or [], timestamp + 0.5 / fps) - 1
+        # seek 到关键帧本身，早一点都会落到上一个 GOP，多解码一整个 GOP
+        # 不知道关键帧位置时每个时间点单独 seek
+        seek = keyframes[idx] if idx >= 0 else timestamp
+        groups.setdefault(seek, []).append(timestamp)
+    return sorted(groups.items())
+
+
+def write_frames_at(
+    video_path: str,
+    timestamps: list,
+    output_dir: str,
+    video_name: str,
+    fps: float,
+    keyframes: list = None,
+    threads: int = 1,
+) -> int:
+    """写出按时间排序的 timestamps 处的帧，文件名为 {video_name}_{i}.jpeg，返回写出的数量
+
+    每个 GOP 一个输入，seek 到关键帧后只解码到该 GOP 中最后一个选中的帧为止
+    """
+    groups = group_by_gop(timestamps, keyframes, fps)
+    # 与单独 seek 到时间点一致，取该时间点之后的第一帧
+    eps = 1e-4
+    command = ["ffmpeg", "-v", "error"]
+    filters = []
+    for g, (seek, group) in enumerate(groups):
+        command += [
+            "-threads",
+            str(threads),
+            "-ss",
+            f"{seek:.6f}",
+            "-t",
+            f"{group[-1] - seek + 1 / fps:.6f}",
+            "-i",
+            video_path,
+        ]
+        select = "+".join(
+            f"gte(t\\,{lo:.6f})*lt(t\\,{lo + 1 / fps:.6f})"
+            for lo in (timestamp - seek - eps for timestamp in group)
+        )
+        filters.append(f"[{g}:v:0]select='{select}'[v{g}]")
+    tmp_dir = tempfile.mkdtemp(prefix=f".{video_name}_", dir=output_dir)
+    command += ["-filter_complex", ";".join(filters)]
+    for g in range(len(groups)):
+        command += [
+            "-map",
+            f"[v{g}]",
+            "-vsync",
+            "vfr",
+            "-q:v",
+            "2",
+            os.path.join(tmp_dir, f"{g}_%d.jpeg"),
+        ]
+    num_written = 0
+    try:
+        subprocess.run(command, check=True)
+        i = 0
+        for g, (_, group) in enumerate(groups):
+            for k, timestamp in enumerate(group):
+                tmp_path = os.path.join(tmp_dir, f"{g}_{k + 1}.jpeg")
+                if os.path.exists(tmp_path):
+                    os.replace(tmp_path, os.path.join(output_dir, f"{video_name}_{i}.jpeg"))
+                    num_written += 1
+                else:
+                    logger.warning(f"Frame at {timestamp} of {video_path} is missing")
+                i += 1
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return num_written
+
+
+def extract_segments_keyframes(
+    video_path: str,
+    segments: list,
+    output_dir: str,
+    fps: float,
+    num_key_frames: int = 15,
+    threads: int = 1,
+    keyframes: list = None,
+) -> list:
+    """只解码一遍长视频的缩略图，为其中的每个片段挑选并写出关键帧
+
+    segments: [(开始, 结束, 片段名), ...]，返回每个片段的 (写出的数量, 选中的数量)
+    """
+    if not segments:
+        return []
+    start = min(segment[0] for segment in segments)
+    end = max(segment[1] for segment in segments)
+    scores = score_frames(video_path, threads=threads, start=start, end=end, fps=fps)
+    counts = []
+    for seg_start, seg_end, video_name in segments:
+        lo = int(round((seg_start - start) * fps))
+        hi = min(int(round((seg_end - start) * fps)), len(scores))
+        segment_scores = scores[lo:hi].copy()
+        # 片段的第一帧没有前一帧，与单独解码片段时一致
+        segment_scores[:1] = 0
+        frame_indices = select_frames(segment_scores, num_key_frames)
+        if not frame_indices:
+            logger.warning(f"No frame decoded for {video_name} from {video_path}")
+            counts.append((0, 0))
+            continue
+        timestamps = [start + (lo + idx) / fps for idx in frame_indices]
+        num_written = write_frames_at(
+            video_path, timestamps, output_dir, video_name, fps, keyframes, threads
+        )
+        counts.append((num_written, len(frame_indices)))
+    return counts
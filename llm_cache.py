@@ -0,0 +1,139 @@
+"""
+@File    :   llm_cache.py
+@Time    :   2023/12/12 09:25:37
+@Author  :   TankNee
+@Version :   1.0
+@Desc    :   基于 SQLite 的大模型回复缓存，按 模型 + 提示词 + 采样参数 的哈希寻址
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from loguru import logger
+
+import metrics
+
+# 淘汰时每次读取的行数
+EVICT_BATCH = 1000
+
+
+class LLMCache:
+    """超过 max_bytes 时按最近访问时间淘汰最旧的回复"""
+
+    def __init__(self, path: str, max_bytes: int = 1 << 30):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL
+            )
+            """
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_last_access ON responses (last_access)"
+        )
+        self.conn.commit()
+        self.total_bytes = self.conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()[0]
+
+    @staticmethod
+    def make_key(model: str, messages: list, params: dict) -> str:
+        payload = json.dumps(
+            {"model": model, "messages": messages, "params": params},
+            ensure_ascii=False,
+            sort_keys=True,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str):
+        return self.get_any([key])
+
+    def get_any(self, keys: list):
+        """依次查找 keys，返回第一个命中的回复，整次查找只记一次命中或未命中"""
+        with self.lock:
+            for key in keys:
+                row = self.conn.execute(
+                    "SELECT value FROM responses WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    break
+            else:
+                self.misses += 1
+                metrics.count("llm_cache_misses")
+                return None
+            self.hits += 1
+            metrics.count("llm_cache_hits")
+            self.conn.execute(
+                "UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key)
+            )
+            self.conn.commit()
+            return row[0]
+
+    def put(self, key: str, value: str):
+        size = len(value.encode("utf-8"))
+        with self.lock:
+            old = self.conn.execute(
+                "SELECT size FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, last_access) VALUES (?, ?, ?, ?)",
+                (key, value, size, time.time()),
+            )
+            self.total_bytes += size - (old[0] if old else 0)
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+            self.conn.commit()
+
+    def _evict(self):
+        # 淘汰到上限的 90%，避免每次写入都触发淘汰
+        target = self.max_bytes * 0.9
+        evicted = 0
+        while self.total_bytes > target:
+            # 每次只取最旧的一批，不把整张表读进内存
+            rows = self.conn.execute(
+                "SELECT key, size FROM responses ORDER BY last_access LIMIT ?",
+                (EVICT_BATCH,),
+            ).fetchall()
+            if not rows:
+                break
+            keys = []
+            for key, size in rows:
+                if self.total_bytes <= target:
+                    break
+                keys.append((key,))
+                self.total_bytes -= size
+            self.conn.executemany("DELETE FROM responses WHERE key = ?", keys)
+            evicted += len(keys)
+        logger.info(f"Evict {evicted} responses from {self.path}")
+
+    def stats(self) -> dict:
+        with self.lock:
+            entries = self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": entries,
+            "bytes": self.total_bytes,
+        }
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,132 @@
+"""
+@File    :   media.py
+@Time    :   2023/12/05 10:12:40
+@Author  :   TankNee
+@Version :   1.0
+@Desc    :   使用 ffprobe 读取视频元信息，并按 路径 + 大小 + 修改时间 缓存到磁盘
+"""
+
+import hashlib
+import json
+import os
+import subprocess
+
+from loguru import logger
+
+import metrics
+from common import read_json, write_json
+
+MEDIA_CACHE_DIR = os.getenv("MEDIA_CACHE_DIR", "./.cache/media")
+
+
+def _cache_path(video_path: str) -> str:
+    stat = os.stat(video_path)
+    key = f"{os.path.abspath(video_path)}|{stat.st_size}|{stat.st_mtime_ns}"
+    return os.path.join(
+        MEDIA_CACHE_DIR, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".json"
+    )
+
+
+def _read_cache(video_path: str) -> dict:
+    cache_path = _cache_path(video_path)
+    if not os.path.exists(cache_path):
+        return {}
+    try:
+        return read_json(cache_path)
+    except (OSError, ValueError):
+        logger.warning(f"Media cache {cache_path} is broken, ignore it")
+        return {}
+
+
+def _write_cache(video_path: str, entry: dict):
+    cache_path = _cache_path(video_path)
+    os.makedirs(MEDIA_CACHE_DIR, exist_ok=True)
+    # 原子写入，多进程同时写入也不会读到半个文件
+    write_json(cache_path, entry, compact=True, atomic=True)
+
+
+@metrics.span("ffprobe")
+def _ffprobe(args: list, video_path: str) -> str:
+    return subprocess.run(
+        ["ffprobe", "-v", "error", *args, video_path],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+
+
+def _parse_rate(rate: str) -> float:
+    num, _, den = rate.partition("/")
+    if not den:
+        return float(num)
+    return float(num) / float(den) if float(den) else 0.0
+
+
+def probe_media(video_path: str) -> dict:
+    """返回 duration、fps、width、height"""
+    entry = _read_cache(video_path)
+    if "info" in entry:
+        metrics.count("media_cache_hits")
+        return entry["info"]
+    metrics.count("media_cache_misses")
+
+    output = json.loads(
+        _ffprobe(
+            [
+                "-select_streams",
+                "v:0",
+                "-show_entries",
+                "format=duration:stream=width,height,avg_frame_rate,r_frame_rate",
+                "-of",
+                "json",
+            ],
+            video_path,
+        )
+    )
+    stream = output["streams"][0] if output.get("streams") else {}
+    fps = _parse_rate(stream.get("avg_frame_rate", "0/0"))
+    if not fps:
+        fps = _parse_rate(stream.get("r_frame_rate", "0/0"))
+    info = dict(
+        duration=float(output["format"]["duration"]),
+        fps=fps,
+        width=stream.get("width"),
+        height=stream.get("height"),
+    )
+    entry["info"] = info
+    _write_cache(video_path, entry)
+    return info
+
+
+def get_duration(video_path: str) -> float:
+    return probe_media(video_path)["duration"]
+
+
+def get_keyframes(video_path: str) -> list:
+    """返回视频流中所有关键帧的时间戳（秒），只读取数据包标记，不解码画面"""
+    entry = _read_cache(video_path)
+    if "keyframes" in entry:
+        metrics.count("media_cache_hits")
+        return entry["keyframes"]
+    metrics.count("media_cache_misses")
+
+    output = _ffprobe(
+        [
+            "-select_streams",
+            "v:0",
+            "-show_entries",
+            "packet=pts_time,flags",
+            "-of",
+            "csv=p=0",
+        ],
+        video_path,
+    )
+    keyframes = []
+    for line in output.splitlines():
+        pts_time, _, flags = line.partition(",")
+        if "K" in flags and pts_time not in ("", "N/A"):
+            keyframes.append(float(pts_time))
+    keyframes.sort()
+    entry["keyframes"] = keyframes
+    _write_cache(video_path, entry)
+    return keyframes
@@ -0,0 +1,371 @@
+"""
+@File    :   metrics.py
+@Time    :   2023/12/22 16:05:51
+@Author  :   TankNee
+@Version :   1.0
+@Desc    :   轻量的耗时与吞吐统计，导出 Prometheus textfile、JSON 汇总和 Chrome trace
+"""
+
+import atexit
+import bisect
+import functools
+import inspect
+import json
+import os
+import threading
+import time
+from urllib.parse import urlparse
+
+from loguru import logger
+
+PREFIX = "lplgpt_"
+TIME_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600,
+)
+BYTES_BUCKETS = tuple(1 << i for i in range(10, 36, 2))  # 1KB ~ 32GB
+# 多天运行时 trace 只保留前面的事件，避免内存无限增长
+MAX_TRACE_EVENTS = 200000
+
+
+def _buckets_for(name: str) -> tuple:
+    return BYTES_BUCKETS if name.endswith("bytes") else TIME_BUCKETS
+
+
+def _label_key(labels: dict) -> tuple:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+class Histogram:
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = float("inf")
+        self.max = float("-inf")
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        # 用桶的上界估计分位数，落在最后一个桶时返回最大值
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class Registry:
+    """进程内的计数器、直方图和 trace 事件"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.events = []
+        self.dropped = 0
+
+    def count(self, name: str, value: float, labels: tuple):
+        with self.lock:
+            key = (name, labels)
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, labels: tuple):
+        with self.lock:
+            key = (name, labels)
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(_buckets_for(name))
+            histogram.observe(value)
+
+    def trace(self, event: dict):
+        with self.lock:
+            if len(self.events) < MAX_TRACE_EVENTS:
+                self.events.append(event)
+            else:
+                self.dropped += 1
+
+
+class _State:
+    job = None
+    output_dir = None
+    # 子进程把数据逐行追加到 spool 文件，由主进程汇总
+    is_child = False
+    spool_file = None
+    spool_offsets = {}
+    trace_written = -1
+
+
+_registry = Registry()
+_state = _State()
+
+
+def _spool_dir() -> str:
+    return os.path.join(_state.output_dir, f"{_state.job}.spool")
+
+
+def _spool(record: dict):
+    if _state.spool_file is None:
+        os.makedirs(_spool_dir(), exist_ok=True)
+        _state.spool_file = open(
+            os.path.join(_spool_dir(), f"{os.getpid()}.jsonl"), "a", encoding="utf-8"
+        )
+    # 每条记录立即写出，进程池 terminate 子进程时也不会丢失
+    with _registry.lock:
+        _state.spool_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        _state.spool_file.flush()
+
+
+def count(name: str, value: float = 1, **labels):
+    """计数器，例如 count("clips", len(clips), stage="split")"""
+    if _state.is_child:
+        _spool({"type": "count", "name": name, "value": value, "labels": labels})
+    else:
+        _registry.count(name, value, _label_key(labels))
+
+
+def observe(name: str, value: float, **labels):
+    """直方图，名字以 bytes 结尾时使用字节大小的桶，否则使用秒的桶"""
+    if _state.is_child:
+        _spool({"type": "observe", "name": name, "value": value, "labels": labels})
+    else:
+        _registry.observe(name, value, _label_key(labels))
+
+
+def _record_span(name: str, start_us: int, duration: float, labels: dict, error: bool):
+    event = {
+        "name": name,
+        "ph": "X",
+        "ts": start_us,
+        "dur": int(duration * 1e6),
+        "pid": os.getpid(),
+        "tid": threading.get_native_id(),
+        "args": labels,
+    }
+    if _state.is_child:
+        _spool({"type": "span", "event": event, "error": error})
+        return
+    _registry.trace(event)
+    _registry.observe("span_seconds", duration, _label_key(dict(labels, span=name)))
+    if error:
+        _registry.count("span_errors", 1, _label_key({"span": name}))
+
+
+class span:
+    """记录一段代码的耗时，可以作为 with 语句或者装饰器（支持 async 函数）使用"""
+
+    def __init__(self, name: str, **labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start_us = time.time_ns() // 1000
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _record_span(
+            self.name,
+            self.start_us,
+            time.perf_counter() - self.start,
+            self.labels,
+            exc_type is not None,
+        )
+
+    def __call__(self, func):
+        if inspect.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(self.name, **self.labels):
+                    return await func(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(self.name, **self.labels):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+
+def get_host(url: str) -> str:
+    # 按域名统计 HTTP 请求，完整 URL 的基数太大
+    return urlparse(url).netloc
+
+
+# ---------------- 汇总与导出 ----------------
+
+
+def _ingest_spool():
+    """把子进程新追加的记录合并到主进程"""
+    spool_dir = _spool_dir()
+    if not os.path.isdir(spool_dir):
+        return
+    for name in sorted(os.listdir(spool_dir)):
+        path = os.path.join(spool_dir, name)
+        offset = _state.spool_offsets.get(path, 0)
+        with open(path, "rb") as f:
+            f.seek(offset)
+            data = f.read()
+        # 只处理完整的行，写了一半的行留到下一次
+        end = data.rfind(b"\n") + 1
+        _state.spool_offsets[path] = offset + end
+        for line in data[:end].splitlines():
+            record = json.loads(line)
+            if record["type"] == "span":
+                event = record["event"]
+                _registry.trace(event)
+                labels = dict(event["args"], span=event["name"])
+                _registry.observe("span_seconds", event["dur"] / 1e6, _label_key(labels))
+                if record["error"]:
+                    _registry.count("span_errors", 1, _label_key({"span": event["name"]}))
+            elif record["type"] == "count":
+                _registry.count(record["name"], record["value"], _label_key(record["labels"]))
+            else:
+                _registry.observe(record["name"], record["value"], _label_key(record["labels"]))
+
+
+def _format_labels(labels: tuple, extra: dict = None) -> str:
+    items = list(labels) + list((extra or {}).items())
+    if not items:
+        return ""
+    values = ",".join(
+        '{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in items
+    )
+    return "{" + values + "}"
+
+
+def to_prometheus() -> str:
+    lines = []
+    with _registry.lock:
+        counters = sorted(_registry.counters.items())
+        histograms = sorted(_registry.histograms.items(), key=lambda item: item[0])
+    for name in sorted({name for (name, _), _ in counters}):
+        lines.append(f"# TYPE {PREFIX}{name}_total counter")
+        for (key_name, labels), value in counters:
+            if key_name == name:
+                lines.append(f"{PREFIX}{name}_total{_format_labels(labels)} {value}")
+    for name in sorted({name for (name, _), _ in histograms}):
+        lines.append(f"# TYPE {PREFIX}{name} histogram")
+        for (key_name, labels), histogram in histograms:
+            if key_name != name:
+                continue
+            cumulative = 0
+            for bound, value in zip(histogram.buckets, histogram.counts):
+                cumulative += value
+                le = _format_labels(labels, {"le": bound})
+                lines.append(f"{PREFIX}{name}_bucket{le} {cumulative}")
+            inf = _format_labels(labels, {"le": "+Inf"})
+            lines.append(f"{PREFIX}{name}_bucket{inf} {histogram.count}")
+            lines.append(f"{PREFIX}{name}_sum{_format_labels(labels)} {histogram.sum}")
+            lines.append(f"{PREFIX}{name}_count{_format_labels(labels)} {histogram.count}")
+    return "\n".join(lines) + "\n"
+
+
+def summary() -> dict:
+    with _registry.lock:
+        counters = dict(_registry.counters)
+        histograms = dict(_registry.histograms)
+        dropped = _registry.dropped
+    result = {"job": _state.job, "counters": {}, "histograms": {}}
+    for (name, labels), value in sorted(counters.items()):
+        result["counters"][name + _format_labels(labels)] = value
+    for (name, labels), histogram in sorted(histograms.items(), key=lambda item: item[0]):
+        result["histograms"][name + _format_labels(labels)] = {
+            "count": histogram.count,
+            "sum": round(histogram.sum, 6),
+            "mean": round(histogram.sum / histogram.count, 6),
+            "min": histogram.min,
+            "p50": histogram.quantile(0.5),
+            "p95": histogram.quantile(0.95),
+            "max": histogram.max,
+        }
+    result["trace_events_dropped"] = dropped
+    return result
+
+
+def _write_atomic(path: str, text: str):
+    # textfile collector 可能随时读取，先写临时文件再重命名
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+_export_lock = threading.Lock()
+
+
+def export():
+    """写出 {job}.prom、{job}.summary.json 和 {job}.trace.json"""
+    if _state.job is None or _state.is_child:
+        return
+    with _export_lock:
+        _export()
+
+
+def _export():
+    _ingest_spool()
+    base = os.path.join(_state.output_dir, _state.job)
+    _write_atomic(base + ".prom", to_prometheus())
+    _write_atomic(base + ".summary.json", json.dumps(summary(), ensure_ascii=False, indent=4))
+    with _registry.lock:
+        events = list(_registry.events)
+    # trace 可能很大，没有新事件时不重写
+    if len(events) != _state.trace_written:
+        _write_atomic(base + ".trace.json", json.dumps({"traceEvents": events}))
+        _state.trace_written = len(events)
+
+
+def _export_loop(interval: float):
+    while True:
+        time.sleep(interval)
+        try:
+            export()
+        except Exception as e:
+            logger.warning(f"Export metrics failed: {e}")
+
+
+def _after_fork_in_child():
+    # fork 出的子进程不能带着父进程已有的数据，否则汇总时会重复计算
+    global _registry
+    _registry = Registry()
+    if _state.job is not None:
+        _state.is_child = True
+        _state.spool_file = None
+
+
+def init(job: str, output_dir: str = None, interval: float = 60):
+    """在脚本入口调用一次，之后每 interval 秒以及退出时导出一次"""
+    output_dir = output_dir or os.getenv("METRICS_DIR", "outputs/metrics")
+    os.makedirs(output_dir, exist_ok=True)
+    _state.job = job
+    _state.output_dir = output_dir
+    _state.is_child = False
+    # spawn 出的子进程通过环境变量找到 spool 目录
+    os.environ["METRICS_DIR"] = output_dir
+    os.environ["METRICS_JOB"] = job
+    os.environ["METRICS_PARENT"] = str(os.getpid())
+    spool_dir = _spool_dir()
+    if os.path.isdir(spool_dir):
+        for name in os.listdir(spool_dir):
+            os.remove(os.path.join(spool_dir, name))
+    threading.Thread(target=_export_loop, args=(interval,), daemon=True).start()
+    atexit.register(export)
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+if os.getenv("METRICS_JOB") and os.getenv("METRICS_PARENT") != str(os.getpid()):
+    # 由 spawn 启动的子进程
+    _state.job = os.environ["METRICS_JOB"]
+    _state.output_dir = os.environ["METRICS_DIR"]
+    _state.is_child = True
@@ -0,0 +1,498 @@
+"""
+@File    :   pipeline.py
+@Time    :   2023/12/20 10:12:05
+@Author  :   TankNee
+@Version :   1.0
+@Desc    :   流式运行所有阶段，每个分P完成一个阶段后立即进入下一个阶段
+"""
+
+import argparse
+import functools
+import glob
+import os
+import queue
+import threading
+import time
+from multiprocessing import get_context
+
+from loguru import logger
+
+import bilibili
+import metrics
+from catalog import Catalog, get_part_name
+from common import JsonlAppender, create_logger, read_json, read_yaml, write_json
+from cut import cut_part
+from download import download, get_video_info_http
+from extract import (
+    _extract_task,
+    count_keyframes,
+    get_manifest_path,
+    get_video_name,
+    load_done_videos,
+)
+from media import get_duration
+from ratelimit import HostRateLimiter
+from split import cut_subtitle, cut_transcript, split_one
+from transcript import TranscriptStore, TranscriptWriter
+
+_STOP = object()
+# 以切分后的片段为单位的阶段，都直接消费 split 的输出
+CLIP_STAGES = ("extract", "refine")
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default="config/pipeline.yaml")
+    return parser.parse_args()
+
+
+class Stage:
+    """一个阶段：有界队列 + 固定数量的工作线程，下游队列满时上游阻塞等待"""
+
+    def __init__(self, name, func, workers=1, queue_size=0, on_error=None):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.on_error = on_error
+        self.queue = queue.Queue(maxsize=queue_size or workers * 2)
+        self.outputs = []
+        self.threads = []
+        self.lock = threading.Lock()
+        self.busy = 0
+        self.done = 0
+        self.failed = 0
+
+    def connect(self, *stages):
+        self.outputs.extend(stages)
+
+    def put(self, item):
+        # 队列满时阻塞的时间就是下游造成的背压
+        start = time.monotonic()
+        self.queue.put((start, item))
+        metrics.observe("queue_put_wait_seconds", time.monotonic() - start, stage=self.name)
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(
+                target=self._run, name=f"{self.name}-{i}", daemon=True
+            )
+            thread.start()
+            self.threads.append(thread)
+
+    def close(self):
+        # 上游已全部结束，停止标记排在所有任务之后
+        for _ in self.threads:
+            self.queue.put(_STOP)
+        for thread in self.threads:
+            thread.join()
+
+    def stats(self) -> str:
+        return (
+            f"{self.name}: queued={self.queue.qsize()} busy={self.busy} "
+            f"done={self.done} failed={self.failed}"
+        )
+
+    def _run(self):
+        while True:
+            entry = self.queue.get()
+            if entry is _STOP:
+                break
+            enqueued, item = entry
+            metrics.observe("queue_wait_seconds", time.monotonic() - enqueued, stage=self.name)
+            with self.lock:
+                self.busy += 1
+            try:
+                with metrics.span("stage", stage=self.name):
+                    results = self.func(item) or []
+            except Exception as e:
+                logger.error(f"[{self.name}] {describe(item)} 失败: {e}")
+                metrics.count("stage_items", stage=self.name, status="failed")
+                with self.lock:
+                    self.busy -= 1
+                    self.failed += 1
+                if self.on_error is not None:
+                    self.on_error(self.name, item)
+                continue
+            metrics.count("stage_items", stage=self.name, status="done")
+            with self.lock:
+                self.busy -= 1
+                self.done += 1
+            for result in results:
+                for stage in self.outputs:
+                    stage.put(result)
+
+
+def describe(item) -> str:
+    if isinstance(item, dict):
+        return item.get("name") or item.get("video_path")
+    return str(item)
+
+
+def _split_part(task):
+    # 在子进程中读取字幕并切分，返回 [(片段路径, 字幕路径), ...]，
+    # 同时提取关键帧时每项还有关键帧的状态和数量
+    video_path, raw_video_path, subtitle_path, transcript_dir, kwargs = task
+    cut_duration = get_duration(raw_video_path) - get_duration(video_path)
+    if transcript_dir is not None:
+        store = TranscriptStore(transcript_dir)
+        subtitle = cut_transcript(store.read(get_video_name(video_path)), cut_duration)
+    else:
+        subtitle = cut_subtitle(read_json(subtitle_path), cut_duration)
+    return split_one(video_path, subtitle, progress=False, **kwargs)
+
+
+@functools.lru_cache(maxsize=256)
+def get_view(bvid: str) -> dict:
+    # 同一个视频的所有分P共用一次查询
+    return bilibili.get_view(bvid)
+
+
+class Pipeline:
+    """metadata -> subtitle -> download -> recognize -> cut -> split -> extract / refine"""
+
+    def __init__(self, config: dict):
+        self.config = config
+        self.dirs = config["dirs"]
+        self.stage_configs = config["stages"]
+        self.subtitle_source = config.get("subtitle_source", "bilibili")
+        for path in self.dirs.values():
+            os.makedirs(path, exist_ok=True)
+        self.catalog = Catalog(config["catalog"])
+        if config.get("record_file"):
+            self.catalog.import_jsonl(config["record_file"])
+        self.limiter = HostRateLimiter(
+            self.stage_configs.get("download", {}).get("host_rate", 0.2)
+        )
+        self.local = threading.local()
+        # metrics.init 已经启动了导出线程，fork 会复制持有锁的线程状态，
+        # 用 spawn 启动子进程，子进程通过环境变量找到 metrics 的 spool 目录
+        self.pools = {
+            name: get_context("spawn").Pool(cfg.get("workers", 1))
+            for name, cfg in self.stage_configs.items()
+            if name in config["run"] and cfg.get("processes")
+        }
+        self.stages = []
+        self.writers = []
+        self.keyframes_writer = None
+        for name in config["run"]:
+            cfg = self.stage_configs.get(name, {})
+            getattr(self, f"setup_{name}", lambda cfg: None)(cfg)
+            stage = Stage(
+                name,
+                getattr(self, name),
+                workers=cfg.get("workers", 1),
+                queue_size=cfg.get("queue_size", 0),
+                on_error=self.mark_failed,
+            )
+            upstream = self.stages[-1] if self.stages else None
+            if name in CLIP_STAGES and upstream and upstream.name in CLIP_STAGES:
+                upstream = next((s for s in self.stages if s.name == "split"), upstream)
+            if upstream is not None:
+                upstream.connect(stage)
+            self.stages.append(stage)
+
+    def mark_failed(self, stage: str, item: dict):
+        if isinstance(item, dict) and "record" in item:
+            self.catalog.set_status(item["name"], stage, "failed")
+
+    # ---------------- 分P级别的阶段 ----------------
+
+    def metadata(self, video_url: str) -> list:
+        record = self.catalog.get(video_url)
+        if record is None:
+            teams, date, playlist_idx, start_point = get_video_info_http(video_url)
+            record = {
+                "url": video_url,
+                "teams": teams,
+                "date": date,
+                "playlist_idx": playlist_idx,
+                "start_point": start_point,
+            }
+            self.catalog.upsert(record)
+        if not record["teams"] or not record["playlist_idx"]:
+            return []
+        return [
+            {
+                "name": get_part_name(record, idx),
+                "url": record["url"] + f"?p={page}",
+                "page": page,
+                "record": record,
+            }
+            for idx, page in enumerate(record["playlist_idx"])
+        ]
+
+    def subtitle(self, part: dict) -> list:
+        file_name = os.path.join(self.dirs["subtitles"], part["name"] + ".json")
+        if not os.path.exists(file_name):
+            bvid = bilibili.get_bvid(part["record"]["url"])
+            view = get_view(bvid)
+            cid = view["pages"][part["page"] - 1]["cid"]
+            subtitle = bilibili.get_subtitle(cid, view["aid"], bvid)
+            if subtitle is None:
+                self.catalog.set_status(part["name"], "subtitle", "missing")
+                # 使用 B 站字幕切分时，没有字幕的分P不必下载
+                if self.subtitle_source == "bilibili":
+                    logger.warning(f"{part['name']} 没有字幕，跳过")
+                    return []
+                return [part]
+            write_json(file_name, subtitle, atomic=True)
+        self.catalog.set_status(part["name"], "subtitle")
+        return [part]
+
+    def download(self, part: dict) -> list:
+        if not os.path.exists(os.path.join(self.dirs["raw_videos"], part["name"] + ".mp4")):
+            download(part["url"], part["name"], self.dirs["raw_videos"], self.limiter)
+        self.catalog.set_status(part["name"], "download")
+        return [part]
+
+    def setup_recognize(self, cfg: dict):
+        self.transcripts = TranscriptStore(self.dirs["transcripts"])
+
+    def recognize(self, part: dict) -> list:
+        from faster_whisper import WhisperModel
+
+        from recognize import SAMPLE_RATE, iter_segments, load_audio
+
+        name = part["name"]
+        if not self.transcripts.is_done(name):
+            cfg = self.stage_configs["recognize"]
+            # 每个工作线程加载一个模型
+            model = getattr(self.local, "model", None)
+            if model is None:
+                model = self.local.model = WhisperModel(**cfg["model"])
+            video_path = os.path.join(self.dirs["raw_videos"], name + ".mp4")
+            audio = load_audio(video_path)
+            offset = self.transcripts.last_timestamp(name)
+            audio = audio[int(offset * SAMPLE_RATE) :]
+            writer = TranscriptWriter(
+                self.transcripts, name, cfg.get("flush_segments", 20)
+            )
+            for row in iter_segments(model, video_path, audio, offset):
+                writer.write(row)
+            writer.close()
+        self.catalog.set_status(name, "recognize")
+        return [part]
+
+    def cut(self, part: dict) -> list:
+        name = part["name"]
+        output_file = os.path.join(self.dirs["cut_videos"], name + ".mp4")
+        if not os.path.exists(output_file):
+            start_point = self.catalog.get_start_point(name, part["url"], part["record"])
+            if start_point is None:
+                bvid = bilibili.get_bvid(part["record"]["url"])
+                view = get_view(bvid)
+                cid = view["pages"][part["page"] - 1]["cid"]
+                start_point = bilibili.get_start_point(cid, view["aid"], bvid)
+                if start_point is None:
+                    logger.warning(f"获取 {name} 的开始时间失败，不剪切片头")
+                    start_point = 0
+                else:
+                    self.catalog.set_start_point(name, start_point)
+            input_file = os.path.join(self.dirs["raw_videos"], name + ".mp4")
+            if not cut_part(name, input_file, output_file, start_point):
+                return []
+        self.catalog.set_status(name, "cut")
+        return [part]
+
+    def setup_split(self, cfg: dict):
+        self.split_writer = JsonlAppender(
+            os.path.join(self.dirs["split"], "manifest.jsonl")
+        )
+        self.writers.append(self.split_writer)
+        if cfg.get("keyframes"):
+            if cfg.get("mode", "copy") != "copy":
+                raise ValueError("split.keyframes 只支持 copy 模式")
+            self.setup_keyframes(cfg.get("num_key_frames", 15))
+
+    def split(self, part: dict) -> list:
+        name = part["name"]
+        if self.catalog.get_status(name, "split") == "done":
+            # 已经切分过，重新把片段交给下游，下游会跳过已完成的片段
+            pattern = os.path.join(
+                glob.escape(self.dirs["split"]), "videos", f"{glob.escape(name)}_*.mp4"
+            )
+            return [
+                {
+                    "video_path": clip,
+                    "subtitle_path": os.path.join(
+                        self.dirs["split"],
+                        "subtitles",
+                        get_video_name(clip) + ".json",
+                    ),
+                }
+                for clip in sorted(glob.glob(pattern))
+            ]
+        cfg = self.stage_configs["split"]
+        transcript_dir = None
+        if self.subtitle_source == "transcript":
+            transcript_dir = self.dirs["transcripts"]
+        kwargs = dict(
+            output_dir=self.dirs["split"],
+            interval=cfg.get("interval", 30),
+            batch_size=cfg.get("batch_size", 32),
+            threads=cfg.get("threads", 1),
+            compact_json=cfg.get("compact_json", True),
+        )
+        if cfg.get("keyframes"):
+            kwargs["num_key_frames"] = cfg.get("num_key_frames", 15)
+        else:
+            kwargs["mode"] = cfg.get("mode", "copy")
+        task = (
+            os.path.join(self.dirs["cut_videos"], name + ".mp4"),
+            os.path.join(self.dirs["raw_videos"], name + ".mp4"),
+            os.path.join(self.dirs["subtitles"], name + ".json"),
+            transcript_dir,
+            kwargs,
+        )
+        pool = self.pools.get("split")
+        video_clips = pool.apply(_split_part, (task,)) if pool else _split_part(task)
+        clips = [
+            dict(video_path=video_clip_path, subtitle_path=video_subtitle_path)
+            for video_clip_path, video_subtitle_path, *_ in video_clips
+        ]
+        for clip in clips:
+            self.split_writer.write(clip)
+        if "num_key_frames" in kwargs:
+            # 关键帧已经和切分一起提取，extract 阶段会跳过这些片段
+            for video_clip_path, _, status, num_frames in video_clips:
+                self.record_keyframes(video_clip_path, status, num_frames)
+        self.catalog.set_status(name, "split")
+        return clips
+
+    # ---------------- 片段级别的阶段 ----------------
+
+    def setup_keyframes(self, num_key_frames: int):
+        # split 同时提取关键帧时与 extract 共用清单
+        if self.keyframes_writer is not None:
+            return
+        keyframe_dir = os.path.join(self.dirs["split"], "keyframes")
+        os.makedirs(keyframe_dir, exist_ok=True)
+        manifest_path = get_manifest_path(self.dirs["split"], 0, 1)
+        os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+        # 只在启动时扫描一次关键帧目录
+        self.keyframe_counts = count_keyframes(keyframe_dir)
+        self.keyframes_done = load_done_videos(
+            self.dirs["split"], self.keyframe_counts, num_key_frames
+        )
+        self.keyframes_writer = JsonlAppender(manifest_path)
+        self.writers.append(self.keyframes_writer)
+
+    def record_keyframes(self, video_path: str, status: str, num_frames: int):
+        video_name = get_video_name(video_path)
+        if status == "done":
+            self.keyframes_done.add(video_name)
+        self.keyframes_writer.write(
+            {"video_name": video_name, "status": status, "num_frames": num_frames}
+        )
+
+    def setup_extract(self, cfg: dict):
+        self.setup_keyframes(cfg.get("num_key_frames", 15))
+
+    def extract(self, clip: dict) -> list:
+        if get_video_name(clip["video_path"]) in self.keyframes_done:
+            return []
+        cfg = self.stage_configs["extract"]
+        task = (
+            clip["video_path"],
+            self.dirs["split"],
+            cfg.get("num_key_frames", 15),
+            cfg.get("engine", "native"),
+            self.keyframe_counts.get(get_video_name(clip["video_path"]), 0),
+        )
+        pool = self.pools.get("extract")
+        video_path, status, num_frames = (
+            pool.apply(_extract_task, (task,)) if pool else _extract_task(task)
+        )
+        self.record_keyframes(video_path, status, num_frames)
+        return []
+
+    def setup_refine(self, cfg: dict):
+        from dotenv import load_dotenv
+        from openai import OpenAI
+
+        import refine
+        from llm_cache import LLMCache
+
+        load_dotenv()
+        self.openai_client = OpenAI(
+            api_key=os.getenv("OPENAI_API_KEY"),
+            base_url=os.getenv("OPENAI_BASE_URL"),
+        )
+        output_path = cfg.get("output_path", "outputs/results.jsonl")
+        if os.path.dirname(output_path):
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        self.refined = refine.load_done_subtitles(output_path)
+        self.llm_cache = None
+        if cfg.get("cache_path"):
+            self.llm_cache = LLMCache(
+                cfg["cache_path"], max_bytes=cfg.get("cache_max_mb", 1024) << 20
+            )
+        self.refine_writer = JsonlAppender(output_path)
+        self.writers.append(self.refine_writer)
+
+    def refine(self, clip: dict) -> list:
+        import refine
+
+        if clip["subtitle_path"] in self.refined:
+            return []
+        record = refine.process_subtitle(
+            self.openai_client, clip["subtitle_path"], self.llm_cache
+        )
+        self.refine_writer.write(record)
+        return []
+
+    # ---------------- 调度 ----------------
+
+    def get_sources(self) -> list:
+        if self.config.get("video_list"):
+            return read_json(self.config["video_list"])
+        return [record["url"] for record in self.catalog.records(matches_only=True)]
+
+    def report(self, stop: threading.Event):
+        interval = self.config.get("report_interval", 30)
+        while not stop.wait(interval):
+            logger.info(" | ".join(stage.stats() for stage in self.stages))
+
+    def run(self):
+        stop = threading.Event()
+        reporter = threading.Thread(target=self.report, args=(stop,), daemon=True)
+        start = time.perf_counter()
+        for stage in self.stages:
+            stage.start()
+        reporter.start()
+        try:
+            # 第一个阶段的队列满时在这里阻塞，任务不会一次性堆积在内存中
+            for source in self.get_sources():
+                self.stages[0].put(source)
+        finally:
+            # 按顺序关闭，每个阶段在上游全部结束后才收到停止标记
+            for stage in self.stages:
+                stage.close()
+            stop.set()
+            for writer in self.writers:
+                writer.close()
+            for pool in self.pools.values():
+                pool.close()
+                pool.join()
+            if self.config.get("record_file"):
+                self.catalog.export_jsonl(self.config["record_file"])
+            if getattr(self, "llm_cache", None) is not None:
+                logger.info(f"LLM cache stats: {self.llm_cache.stats()}")
+                self.llm_cache.close()
+            self.catalog.close()
+        for stage in self.stages:
+            logger.info(stage.stats())
+        logger.info(f"Pipeline finished in {time.perf_counter() - start:.1f}s")
+
+
+def main():
+    create_logger("./logs/pipeline.log")
+    metrics.init("pipeline")
+    args = get_args()
+    config = read_yaml(args.config)
+    logger.debug(config)
+    Pipeline(config).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+@File    :   ratelimit.py
+@Time    :   2023/12/10 16:40:52
+@Author  :   TankNee
+@Version :   1.0
+@Desc    :   令牌桶限速与 AIMD 自适应并发控制
+"""
+
+import asyncio
+import threading
+import time
+from urllib.parse import urlparse
+
+
+class AsyncTokenBucket:
+    """每分钟补充 rate_per_minute 个令牌，桶容量默认等于一分钟的配额"""
+
+    def __init__(self, rate_per_minute: float, capacity: float = None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity or rate_per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount: float = 1):
+        # 超过桶容量的请求最多等满一桶，避免永远拿不到令牌
+        amount = min(amount, self.capacity)
+        async with self.lock:
+            while True:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+
+class AIMDLimiter:
+    """加性增、乘性减的并发上限：请求成功时缓慢增加，遇到 429/5xx 时减半"""
+
+    def __init__(
+        self, initial: int = 8, minimum: int = 1, maximum: int = 256, cooldown: float = 5.0
+    ):
+        self.limit = float(initial)
+        self.cooldown = cooldown
+        self.last_decrease = 0.0
+        self.minimum = minimum
+        self.maximum = maximum
+        self.in_flight = 0
+        self.condition = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+        return self
+
+    async def __aexit__(self, *exc):
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def on_success(self):
+        # 每个窗口（约 limit 个成功请求）并发上限加一
+        self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+
+    def on_error(self):
+        # 同一批并发请求同时失败时只减半一次
+        now = time.monotonic()
+        if now - self.last_decrease < self.cooldown:
+            return
+        self.last_decrease = now
+        self.limit = max(self.minimum, self.limit / 2)
+
+
+class TokenBucket:
+    """线程安全的同步令牌桶，每秒补充 rate_per_second 个令牌"""
+
+    def __init__(self, rate_per_second: float, capacity: float = 1):
+        self.rate = rate_per_second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, amount: float = 1):
+        amount = min(amount, self.capacity)
+        with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                time.sleep((amount - self.tokens) / self.rate)
+
+
+class HostRateLimiter:
+    """按域名分别限速，同一域名共用一个令牌桶"""
+
+    def __init__(self, rate_per_second: float, capacity: float = 1):
+        self.rate = rate_per_second
+        self.capacity = capacity
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, url: str):
+        host = urlparse(url).netloc
+        with self.lock:
+            bucket = self.buckets.get(host)
+            if bucket is None:
+                bucket = self.buckets[host] = TokenBucket(self.rate, self.capacity)
+        bucket.acquire()
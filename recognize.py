@@ -1,14 +1,21 @@
 import argparse
 import glob
 import os
+import subprocess
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from multiprocessing import get_context
 
+import numpy as np
 import pandas as pd
 import whisper
 from faster_whisper import WhisperModel
+from faster_whisper.vad import VadOptions, get_speech_timestamps
 from loguru import logger
 from tqdm import tqdm
 
+import metrics
 from common import create_logger
+from transcript import TranscriptStore, TranscriptWriter
 
 
 def get_args():
@@ -17,46 +24,312 @@ def get_args():
     parser.add_argument("--output_dir", type=str, default="outputs")
     parser.add_argument("--model_name", type=str, default="large")
     parser.add_argument("--model_path", type=str, default="faster-whisper-large-v2")
+    parser.add_argument("--device", type=str, default="cuda", choices=["cuda", "cpu"])
+    parser.add_argument(
+        "--compute_type",
+        type=str,
+        default=None,
+        help="默认 cuda 使用 float16，cpu 使用 int8",
+    )
+    parser.add_argument(
+        "--cpu_threads",
+        type=int,
+        default=0,
+        help="每个模型的 CPU 推理线程数，0 表示自动，--parallel_chunks 时平分全部核心",
+    )
+    parser.add_argument(
+        "--num_workers", type=int, default=1, help="同时转写的视频数量，各线程共用一个模型"
+    )
+    parser.add_argument("--prefetch", type=int, default=2, help="提前解码音频的视频数量")
+    parser.add_argument(
+        "--parallel_chunks",
+        type=int,
+        default=0,
+        help="大于 0 时按静音切分音频，使用该数量的模型副本并行转写",
+    )
+    parser.add_argument("--chunk_duration", type=float, default=300, help="每个音频块的目标时长（秒）")
+    parser.add_argument(
+        "--output_format",
+        type=str,
+        default="csv",
+        choices=["csv", "parquet"],
+        help="parquet: 边转写边保存到 output_dir/transcripts，中断后可续转",
+    )
+    parser.add_argument("--flush_segments", type=int, default=20, help="每多少句落盘一次")
     return parser.parse_args()
 
 
-def recognize(model: WhisperModel, video_path: str):
-    df_list = []
-    segments, _ = model.transcribe(
-        video_path,
-        beam_size=5,
-        language="zh",
-        repetition_penalty=1.1,
-        compression_ratio_threshold=2.3,
-        vad_filter=True,
-        vad_parameters=dict(min_silence_duration_ms=800),
-    )
-    logger.info("Transcript the video %s " % video_path)
-    pbar = tqdm(segments)
-    for segment in pbar:
-        df_list.append([segment.start, segment.end, segment.text])
-        pbar.set_postfix(
-            {"End Time": f"{int(segment.end // 60)}:{int(segment.end % 60):02d}"}
+SAMPLE_RATE = 16000
+MIN_SILENCE_DURATION_MS = 800
+TRANSCRIBE_KWARGS = dict(
+    beam_size=5,
+    language="zh",
+    repetition_penalty=1.1,
+    compression_ratio_threshold=2.3,
+    vad_filter=True,
+    vad_parameters=dict(min_silence_duration_ms=MIN_SILENCE_DURATION_MS),
+)
+# 按块转写时已经对整段音频运行过 VAD，块内只转写其中的语音片段
+CHUNK_TRANSCRIBE_KWARGS = {
+    key: value
+    for key, value in TRANSCRIBE_KWARGS.items()
+    if key not in ("vad_filter", "vad_parameters")
+}
+
+
+@metrics.span("load_audio")
+def load_audio(video_path: str) -> np.ndarray:
+    # 使用 ffmpeg 解码为 16kHz 单声道 PCM，在子进程中执行，不占用 GIL
+    output = subprocess.run(
+        [
+            "ffmpeg",
+            "-nostdin",
+            "-v",
+            "error",
+            "-threads",
+            "0",
+            "-i",
+            video_path,
+            "-vn",
+            "-ac",
+            "1",
+            "-ar",
+            str(SAMPLE_RATE),
+            "-f",
+            "s16le",
+            "-",
+        ],
+        capture_output=True,
+        check=True,
+    ).stdout
+    metrics.observe("audio_bytes", len(output))
+    return np.frombuffer(output, dtype=np.int16).astype(np.float32) / 32768.0
+
+
+def prefetch_audio(video_list: list, prefetch: int = 2):
+    # 后台线程提前解码后面的视频，与当前视频的转写重叠执行
+    with ThreadPoolExecutor(max_workers=max(prefetch, 1)) as executor:
+        futures = [executor.submit(load_audio, path) for path in video_list[:prefetch]]
+        for idx, video_path in enumerate(video_list):
+            if idx + prefetch < len(video_list):
+                futures.append(executor.submit(load_audio, video_list[idx + prefetch]))
+            future = futures[idx]
+            yield video_path, future.result()
+            futures[idx] = None
+
+
+def iter_segments(
+    model: WhisperModel, video_path: str, audio: np.ndarray = None, offset: float = 0.0
+):
+    # transcribe 返回惰性的生成器，耗时在遍历时才产生
+    with metrics.span("transcribe"):
+        segments, _ = model.transcribe(
+            video_path if audio is None else audio, **TRANSCRIBE_KWARGS
+        )
+        logger.info("Transcript the video %s " % video_path)
+        pbar = tqdm(segments)
+        for segment in pbar:
+            end = offset + segment.end
+            metrics.count("segments")
+            yield [offset + segment.start, end, segment.text]
+            pbar.set_postfix({"End Time": f"{int(end // 60)}:{int(end % 60):02d}"})
+    if audio is not None:
+        metrics.count("audio_seconds", len(audio) / SAMPLE_RATE)
+
+
+def recognize(model: WhisperModel, video_path: str, audio: np.ndarray = None):
+    df_list = list(iter_segments(model, video_path, audio))
+    df = pd.DataFrame(df_list, columns=["start", "end", "text"])
+    return df
+
+
+def split_on_silence(
+    audio: np.ndarray,
+    chunk_duration: float = 300,
+    min_silence_duration_ms: int = MIN_SILENCE_DURATION_MS,
+) -> list:
+    """运行一次 VAD，只在长于 min_silence_duration_ms 的静音处切分
+
+    返回 [(开始采样点, 结束采样点, 块内的语音片段), ...]，语音片段为相对块开始的
+    [开始秒, 结束秒, ...]，作为 clip_timestamps 传给 transcribe，块内不再重复运行 VAD
+    """
+    speech = get_speech_timestamps(
+        audio, VadOptions(min_silence_duration_ms=min_silence_duration_ms)
+    )
+    chunk_samples = int(chunk_duration * SAMPLE_RATE)
+    boundaries = [0]
+    for prev, cur in zip(speech, speech[1:]):
+        # 在两段语音之间静音的中点切开
+        boundary = (prev["end"] + cur["start"]) // 2
+        if boundary - boundaries[-1] >= chunk_samples:
+            boundaries.append(boundary)
+    if boundaries[-1] < len(audio):
+        boundaries.append(len(audio))
+    chunks = []
+    for start, end in zip(boundaries, boundaries[1:]):
+        clips = []
+        for span in speech:
+            if start <= span["start"] < end:
+                clips += [
+                    (span["start"] - start) / SAMPLE_RATE,
+                    (span["end"] - start) / SAMPLE_RATE,
+                ]
+        chunks.append((start, end, clips))
+    return chunks
+
+
+_worker_model = None
+
+
+def _init_worker(model_kwargs: dict):
+    global _worker_model
+    _worker_model = WhisperModel(**model_kwargs)
+
+
+def _transcribe_chunk(task):
+    offset, audio, clips = task
+    if not clips:
+        # 整块都是静音
+        return []
+    with metrics.span("transcribe_chunk"):
+        segments, _ = _worker_model.transcribe(
+            audio, clip_timestamps=clips, **CHUNK_TRANSCRIBE_KWARGS
         )
+        rows = [
+            [offset + segment.start, offset + segment.end, segment.text]
+            for segment in segments
+        ]
+    metrics.count("segments", len(rows))
+    metrics.count("audio_seconds", len(audio) / SAMPLE_RATE)
+    return rows
+
+
+def iter_chunked_segments(
+    pool,
+    video_path: str,
+    audio: np.ndarray,
+    chunk_duration: float = 300,
+    offset: float = 0.0,
+):
+    chunks = split_on_silence(audio, chunk_duration)
+    logger.info(f"Transcript the video {video_path} in {len(chunks)} chunks")
+    tasks = [
+        (offset + start / SAMPLE_RATE, audio[start:end], clips)
+        for start, end, clips in chunks
+    ]
+    # imap 按提交顺序返回，拼接后的时间轴与整段转写一致
+    for rows in tqdm(pool.imap(_transcribe_chunk, tasks), total=len(tasks)):
+        yield from rows
+
+
+def recognize_chunked(
+    pool, video_path: str, audio: np.ndarray, chunk_duration: float = 300
+):
+    df_list = list(iter_chunked_segments(pool, video_path, audio, chunk_duration))
     df = pd.DataFrame(df_list, columns=["start", "end", "text"])
     return df
 
 
+def get_video_name(video_path: str) -> str:
+    return os.path.basename(video_path).replace(".mp4", "")
+
+
+def get_csv_path(output_dir: str, video_path: str) -> str:
+    return os.path.join(output_dir, get_video_name(video_path) + ".csv")
+
+
+def transcribe_video(model, pool, video_path: str, audio: np.ndarray, args, store):
+    if store is None:
+        if pool is not None:
+            segments_df = recognize_chunked(pool, video_path, audio, args.chunk_duration)
+        else:
+            segments_df = recognize(model, video_path, audio)
+        csv_path = get_csv_path(args.output_dir, video_path)
+        logger.info("Save the result to %s" % csv_path)
+        segments_df.to_csv(csv_path, index=False)
+        return
+
+    video_name = get_video_name(video_path)
+    # 从最后一句已落盘的结束时间继续转写
+    offset = store.last_timestamp(video_name)
+    if offset > 0:
+        logger.info(f"Resume {video_name} from {offset:.2f}s")
+        audio = audio[int(offset * SAMPLE_RATE) :]
+    if pool is not None:
+        rows = iter_chunked_segments(pool, video_path, audio, args.chunk_duration, offset)
+    else:
+        rows = iter_segments(model, video_path, audio, offset)
+    writer = TranscriptWriter(store, video_name, args.flush_segments)
+    for row in rows:
+        writer.write(row)
+    writer.close()
+    logger.info(f"Save the result to {store.get_dir(video_name)}")
+
+
 def main():
     args = get_args()
     create_logger("./logs/recognize.log")
-    video_list = glob.glob(os.path.join(args.video_dir, "*.mp4"))
-    model = WhisperModel(
-        model_size_or_path=args.model_path, device="cuda", compute_type="float16"
+    metrics.init("recognize")
+    video_list = sorted(glob.glob(os.path.join(args.video_dir, "*.mp4")))
+    store = None
+    if args.output_format == "parquet":
+        store = TranscriptStore(os.path.join(args.output_dir, "transcripts"))
+    # 跳过已经完成转写的视频
+    if store is None:
+        done = {
+            path
+            for path in video_list
+            if os.path.exists(get_csv_path(args.output_dir, path))
+        }
+    else:
+        done = {path for path in video_list if store.is_done(get_video_name(path))}
+    if done:
+        logger.info(f"Skip {len(done)} transcribed videos")
+    video_list = [path for path in video_list if path not in done]
+    compute_type = args.compute_type or (
+        "float16" if args.device == "cuda" else "int8"
+    )
+    cpu_threads = args.cpu_threads
+    if args.parallel_chunks > 0 and cpu_threads == 0:
+        # 每个模型副本默认会使用全部核心，多个副本同时运行时平分核心
+        cpu_threads = max(1, (os.cpu_count() or 1) // args.parallel_chunks)
+    model_kwargs = dict(
+        model_size_or_path=args.model_path,
+        device=args.device,
+        compute_type=compute_type,
+        cpu_threads=cpu_threads,
+        num_workers=args.num_workers,
     )
     # load whisper model
-    for video_path in tqdm(video_list):
-        segments_df = recognize(model, video_path)
-        csv_path = os.path.join(
-            args.output_dir, os.path.basename(video_path).replace(".mp4", ".csv")
+    if args.parallel_chunks > 0:
+        # 每个进程加载一个模型副本，使用 spawn 避免 fork 后 CUDA 状态异常
+        model = None
+        pool = get_context("spawn").Pool(
+            args.parallel_chunks, initializer=_init_worker, initargs=(model_kwargs,)
         )
-        logger.info("Save the result to %s" % csv_path)
-        segments_df.to_csv(csv_path, index=False)
+    else:
+        model = WhisperModel(**model_kwargs)
+        pool = None
+    # WhisperModel 的 num_workers 允许多个线程同时调用 transcribe，每个线程转写一个视频
+    with ThreadPoolExecutor(max_workers=max(args.num_workers, 1)) as executor:
+        futures = set()
+        for video_path, audio in tqdm(
+            prefetch_audio(video_list, args.prefetch), total=len(video_list)
+        ):
+            if len(futures) >= args.num_workers:
+                finished, futures = wait(futures, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    future.result()
+            futures.add(
+                executor.submit(
+                    transcribe_video, model, pool, video_path, audio, args, store
+                )
+            )
+        for future in futures:
+            future.result()
+    if pool is not None:
+        pool.close()
+        pool.join()
 
 
 if __name__ == "__main__":
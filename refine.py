@@ -1,12 +1,17 @@
 import argparse
+import asyncio
 import glob
 import json
 import os
 from dotenv import load_dotenv
-from openai import OpenAI
+from loguru import logger
+from openai import APIConnectionError, APIStatusError, AsyncOpenAI, OpenAI
 from tqdm import tqdm
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from common import read_json, read_jsonl, retry
+import metrics
+from common import JsonlAppender, iter_jsonl, read_json, retry
+from llm_cache import LLMCache
+from ratelimit import AIMDLimiter, AsyncTokenBucket
 
 SYSTEM_PROMPT = """你的任务是把用户输入转换为更加流畅自然的表达形式，用户的输入是一场英雄联盟职业比赛的解说词片段，每一行代表一句话，可能是不同的人说的，也可能是同一个人说的，解说词中包含许多英雄联盟专业用语，你需要保留这些特殊用词，也有一些可能是语音识别错误的词语，你需要进行修正，你的输出不能过于书面化，要贴近解说词的真实含义，必要时你可以丢弃部分解说词中表达不完整的内容，不能过于啰嗦，要适当精简。直接输出解说词内容，不要有其他的无关内容。
 """
@@ -14,8 +19,17 @@ SYSTEM_PROMPT = """你的任务是把用户输入转换为更加流畅自然的
 USER_PROMPT = """下面是这场比赛的解说词：
 {subtitle_text}"""
 
+BATCH_SYSTEM_PROMPT = (
+    SYSTEM_PROMPT
+    + """用户会一次给出多个解说词片段，每个片段以“### 片段 编号”开头，请分别改写每个片段。以 JSON 对象输出，键为片段编号，值为改写后的解说词，不要输出其他内容。
+"""
+)
+
+BATCH_USER_PROMPT = """下面是这场比赛的多个解说词片段：
+{subtitle_text}"""
 
-def get_args():
+
+def get_args(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "--subtitle_dir",
@@ -28,42 +42,223 @@ def get_args():
         default="/new_disk/cv_group/tanknee/Data/lpl-gpt/2023-spring-split/videos",
     )
     parser.add_argument("--output_path", type=str, default="outputs/results.jsonl")
+    parser.add_argument(
+        "--engine",
+        type=str,
+        default="thread",
+        choices=["thread", "async"],
+        help="thread: 线程池 + 同步客户端; async: AsyncOpenAI + 限速与自适应并发",
+    )
+    parser.add_argument("--rpm", type=int, default=3500, help="每分钟请求数上限")
+    parser.add_argument("--tpm", type=int, default=160000, help="每分钟 token 数上限")
+    parser.add_argument("--min_concurrency", type=int, default=1)
+    parser.add_argument("--max_concurrency", type=int, default=128)
+    parser.add_argument(
+        "--cache_path",
+        type=str,
+        default="outputs/llm_cache.sqlite",
+        help="大模型回复缓存，设为空字符串关闭缓存",
+    )
+    parser.add_argument("--cache_max_mb", type=int, default=1024)
+    parser.add_argument(
+        "--batch_tokens",
+        type=int,
+        default=0,
+        help="大于 0 时把多个片段打包进一次请求，单个请求输入不超过该 token 数",
+    )
+    parser.add_argument("--max_batch_clips", type=int, default=16)
+
+    return parser.parse_args(argv)
+
+
+MODEL = "gpt-3.5-turbo-1106"
+SAMPLING_PARAMS = dict(seed=2023, temperature=0.1, max_tokens=512)
+RETRY_TIMES = 10
+
+
+def build_messages(subtitle_text):
+    return [
+        {
+            "role": "system",
+            "content": SYSTEM_PROMPT,
+        },
+        {
+            "role": "user",
+            "content": USER_PROMPT.format(subtitle_text=subtitle_text),
+        },
+    ]
+
+
+def build_batch_messages(subtitle_texts):
+    subtitle_text = "\n".join(
+        f"### 片段 {i + 1}\n{text}" for i, text in enumerate(subtitle_texts)
+    )
+    return [
+        {
+            "role": "system",
+            "content": BATCH_SYSTEM_PROMPT,
+        },
+        {
+            "role": "user",
+            "content": BATCH_USER_PROMPT.format(subtitle_text=subtitle_text),
+        },
+    ]
+
+
+def get_batch_params(num_clips):
+    return dict(
+        SAMPLING_PARAMS,
+        max_tokens=min(4096, SAMPLING_PARAMS["max_tokens"] * num_clips),
+        response_format={"type": "json_object"},
+    )
 
-    return parser.parse_args()
 
+def parse_batch_response(content, num_clips):
+    # 返回按片段顺序排列的改写结果，格式不对时返回 None
+    try:
+        outputs = json.loads(content)
+    except (TypeError, ValueError):
+        return None
+    if not isinstance(outputs, dict):
+        return None
+    outputs = [outputs.get(str(i + 1)) for i in range(num_clips)]
+    if not all(isinstance(output, str) and output.strip() for output in outputs):
+        return None
+    return outputs
+
+
+def estimate_tokens(messages, params=SAMPLING_PARAMS):
+    # 中文大约一个字一个 token，加上输出上限作为保守估计
+    return sum(len(m["content"]) for m in messages) + params["max_tokens"]
+
+
+def pack_batches(items, batch_tokens, max_batch_clips):
+    # items: [(subtitle_path, video_path, subtitle_text), ...]，按顺序贪心装箱
+    budget = batch_tokens - len(BATCH_SYSTEM_PROMPT) - len(BATCH_USER_PROMPT)
+    batches, batch, used = [], [], 0
+    for item in items:
+        tokens = len(item[2]) + 16
+        if batch and (used + tokens > budget or len(batch) >= max_batch_clips):
+            batches.append(batch)
+            batch, used = [], 0
+        batch.append(item)
+        used += tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def count_usage(response):
+    if response.usage is not None:
+        metrics.count("llm_tokens", response.usage.prompt_tokens, kind="prompt")
+        metrics.count("llm_tokens", response.usage.completion_tokens, kind="completion")
 
-args = get_args()
 
 @retry(retry_times=10)
+@metrics.span("llm.request", mode="single")
 def refine_subtitle(client: OpenAI, subtitle_text):
     response = client.chat.completions.create(
-        model="gpt-3.5-turbo-1106",
-        messages=[
-            {
-                "role": "system",
-                "content": SYSTEM_PROMPT,
-            },
-            {
-                "role": "user",
-                "content": USER_PROMPT.format(subtitle_text=subtitle_text),
-            },
-        ],
-        seed=2023,
-        temperature=0.1,
-        max_tokens=512,
+        model=MODEL,
+        messages=build_messages(subtitle_text),
+        **SAMPLING_PARAMS,
+    )
+    count_usage(response)
+    return response.choices[0].message.content
+
+
+@retry(retry_times=10)
+@metrics.span("llm.request", mode="batch")
+def refine_batch(client: OpenAI, subtitle_texts):
+    response = client.chat.completions.create(
+        model=MODEL,
+        messages=build_batch_messages(subtitle_texts),
+        **get_batch_params(len(subtitle_texts)),
     )
+    count_usage(response)
     return response.choices[0].message.content
 
 
-def process_subtitle(openai_client, subtitle_path):
-    output_file = read_jsonl(args.output_path)
-    if any([r["subtitle_path"] == subtitle_path for r in output_file]):
-        pre = [r for r in output_file if r["subtitle_path"] == subtitle_path][0]
-        return pre
+def is_retryable(e: Exception) -> bool:
+    if isinstance(e, APIConnectionError):
+        return True
+    return isinstance(e, APIStatusError) and (
+        e.status_code == 429 or e.status_code >= 500
+    )
+
+
+async def request_async(
+    client: AsyncOpenAI,
+    messages,
+    params,
+    limiter: AIMDLimiter,
+    request_bucket: AsyncTokenBucket,
+    token_bucket: AsyncTokenBucket,
+):
+    mode = "batch" if "response_format" in params else "single"
+    for i in range(RETRY_TIMES):
+        with metrics.span("ratelimit.wait", host="openai"):
+            await request_bucket.acquire()
+            await token_bucket.acquire(estimate_tokens(messages, params))
+        async with limiter:
+            try:
+                with metrics.span("llm.request", mode=mode):
+                    response = await client.chat.completions.create(
+                        model=MODEL, messages=messages, **params
+                    )
+            except Exception as e:
+                if not is_retryable(e):
+                    raise
+                limiter.on_error()
+                metrics.count("retries", func="request_async")
+                logger.warning(
+                    f"Request failed, concurrency limit {int(limiter.limit)}, retrying... {e}"
+                )
+            else:
+                limiter.on_success()
+                count_usage(response)
+                return response.choices[0].message.content
+        # 指数退避，上限 30 秒
+        await asyncio.sleep(min(30, 2**i))
+    raise Exception("Function execution failed after multiple retries.")
+
+
+async def refine_subtitle_async(client: AsyncOpenAI, subtitle_text, *limits):
+    return await request_async(
+        client, build_messages(subtitle_text), SAMPLING_PARAMS, *limits
+    )
+
+
+def load_done_subtitles(output_path) -> set:
+    # 只在启动时读取一次已完成的结果
+    if not os.path.exists(output_path):
+        return set()
+    return {r["subtitle_path"] for r in iter_jsonl(output_path)}
+
+
+def read_subtitle(subtitle_path):
     video_path = subtitle_path.replace("subtitles", "videos").replace("json", "mp4")
     subtitle = read_json(subtitle_path)
     subtitle_text = "\n".join([s["text"] for s in subtitle])
-    refined_subtitle = refine_subtitle(openai_client, subtitle_text)
+    return video_path, subtitle_text
+
+
+def get_cache_key(subtitle_text, batch=False):
+    # 打包请求的结果与单独请求的结果分开缓存
+    model = MODEL + "#batch" if batch else MODEL
+    return LLMCache.make_key(model, build_messages(subtitle_text), SAMPLING_PARAMS)
+
+
+def lookup_cache(cache: LLMCache, subtitle_text, batch=False):
+    # 打包模式下单独请求和打包请求的结果都可以用，两个 key 只算一次查找
+    if cache is None:
+        return None
+    keys = [get_cache_key(subtitle_text)]
+    if batch:
+        keys.append(get_cache_key(subtitle_text, batch=True))
+    return cache.get_any(keys)
+
+
+def make_record(subtitle_path, video_path, subtitle_text, refined_subtitle):
     return {
         "video_path": video_path,
         "subtitle_path": subtitle_path,
@@ -72,45 +267,182 @@ def process_subtitle(openai_client, subtitle_path):
     }
 
 
-def main():
-    load_dotenv()
-    openai_client = OpenAI(
+def process_subtitle(openai_client, subtitle_path, cache: LLMCache = None):
+    video_path, subtitle_text = read_subtitle(subtitle_path)
+    refined_subtitle = lookup_cache(cache, subtitle_text)
+    if refined_subtitle is None:
+        refined_subtitle = refine_subtitle(openai_client, subtitle_text)
+        if cache is not None:
+            cache.put(get_cache_key(subtitle_text), refined_subtitle)
+    return make_record(subtitle_path, video_path, subtitle_text, refined_subtitle)
+
+
+def process_batch(openai_client, batch, cache: LLMCache = None):
+    subtitle_texts = [item[2] for item in batch]
+    outputs = parse_batch_response(
+        refine_batch(openai_client, subtitle_texts), len(batch)
+    )
+    if outputs is None:
+        logger.warning(
+            f"Malformed batch response, fall back to {len(batch)} single requests"
+        )
+        return [process_subtitle(openai_client, item[0], cache) for item in batch]
+    if cache is not None:
+        for subtitle_text, output in zip(subtitle_texts, outputs):
+            cache.put(get_cache_key(subtitle_text, batch=True), output)
+    return [make_record(*item, output) for item, output in zip(batch, outputs)]
+
+
+async def process_subtitle_async(
+    openai_client, subtitle_path, limits, cache: LLMCache = None
+):
+    video_path, subtitle_text = read_subtitle(subtitle_path)
+    refined_subtitle = lookup_cache(cache, subtitle_text)
+    if refined_subtitle is None:
+        refined_subtitle = await refine_subtitle_async(
+            openai_client, subtitle_text, *limits
+        )
+        if cache is not None:
+            cache.put(get_cache_key(subtitle_text), refined_subtitle)
+    return make_record(subtitle_path, video_path, subtitle_text, refined_subtitle)
+
+
+async def process_batch_async(openai_client, batch, limits, cache: LLMCache = None):
+    subtitle_texts = [item[2] for item in batch]
+    content = await request_async(
+        openai_client,
+        build_batch_messages(subtitle_texts),
+        get_batch_params(len(batch)),
+        *limits,
+    )
+    outputs = parse_batch_response(content, len(batch))
+    if outputs is None:
+        logger.warning(
+            f"Malformed batch response, fall back to {len(batch)} single requests"
+        )
+        return await asyncio.gather(
+            *[
+                process_subtitle_async(openai_client, item[0], limits, cache)
+                for item in batch
+            ]
+        )
+    if cache is not None:
+        for subtitle_text, output in zip(subtitle_texts, outputs):
+            cache.put(get_cache_key(subtitle_text, batch=True), output)
+    return [make_record(*item, output) for item, output in zip(batch, outputs)]
+
+
+def split_cached(subtitles, args, cache: LLMCache, writer: JsonlAppender):
+    # 命中缓存的片段直接写出，其余的按 token 预算打包
+    items = []
+    for subtitle_path in subtitles:
+        video_path, subtitle_text = read_subtitle(subtitle_path)
+        refined_subtitle = lookup_cache(cache, subtitle_text, batch=True)
+        if refined_subtitle is not None:
+            writer.write(
+                make_record(subtitle_path, video_path, subtitle_text, refined_subtitle)
+            )
+        else:
+            items.append((subtitle_path, video_path, subtitle_text))
+    batches = pack_batches(items, args.batch_tokens, args.max_batch_clips)
+    logger.info(f"Pack {len(items)} subtitles into {len(batches)} requests")
+    return batches
+
+
+async def refine_all_async(
+    subtitles, writer: JsonlAppender, args, cache: LLMCache = None
+):
+    # 重试由 request_async 统一处理，客户端自身不重试
+    openai_client = AsyncOpenAI(
         api_key=os.getenv("OPENAI_API_KEY"),
         base_url=os.getenv("OPENAI_BASE_URL"),
+        max_retries=0,
     )
+    limits = (
+        AIMDLimiter(
+            initial=args.min_concurrency,
+            minimum=args.min_concurrency,
+            maximum=args.max_concurrency,
+        ),
+        AsyncTokenBucket(args.rpm),
+        AsyncTokenBucket(args.tpm),
+    )
+    if args.batch_tokens > 0:
+        tasks = [
+            asyncio.create_task(
+                process_batch_async(openai_client, batch, limits, cache)
+            )
+            for batch in split_cached(subtitles, args, cache, writer)
+        ]
+        # 完成一批写一批
+        for task in tqdm(asyncio.as_completed(tasks), total=len(tasks)):
+            for record in await task:
+                writer.write(record)
+    else:
+        tasks = [
+            asyncio.create_task(
+                process_subtitle_async(openai_client, subtitle_path, limits, cache)
+            )
+            for subtitle_path in subtitles
+        ]
+        # 完成一个写一个
+        for task in tqdm(asyncio.as_completed(tasks), total=len(tasks)):
+            writer.write(await task)
+    await openai_client.close()
 
-    subtitles = glob.glob(os.path.join(args.subtitle_dir, "*.json"))
-    subtitles.sort()
-    with open(args.output_path, "a+") as f:
-        f.seek(0)
-        results = [json.loads(line) for line in f]
-        f.seek(0, 2)
 
-        # 创建线程池
-        executor = ThreadPoolExecutor(max_workers=8)
+def run_thread_pool(openai_client, subtitles, args, cache: LLMCache = None):
+    # 创建线程池，结果由单独的写线程批量追加
+    with ThreadPoolExecutor(max_workers=8) as executor, JsonlAppender(
+        args.output_path
+    ) as writer:
+        if args.batch_tokens > 0:
+            futures = [
+                executor.submit(process_batch, openai_client, batch, cache)
+                for batch in split_cached(subtitles, args, cache, writer)
+            ]
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                for record in future.result():
+                    writer.write(record)
+            return
 
         # 提交任务给线程池执行
         futures = [
-            executor.submit(process_subtitle, openai_client, subtitle_path)
+            executor.submit(process_subtitle, openai_client, subtitle_path, cache)
             for subtitle_path in subtitles
         ]
 
         for future in tqdm(as_completed(futures), total=len(subtitles)):
-            result = future.result()
-            if any([r["subtitle_path"] == result["subtitle_path"] for r in results]):
-                continue
-            results.append(result)
-            f.write(
-                json.dumps(
-                    result,
-                    ensure_ascii=False,
-                )
-                + "\n"
-            )
-            f.flush()
+            writer.write(future.result())
+
+
+def main():
+    args = get_args()
+    metrics.init("refine")
+    load_dotenv()
+    openai_client = OpenAI(
+        api_key=os.getenv("OPENAI_API_KEY"),
+        base_url=os.getenv("OPENAI_BASE_URL"),
+    )
+
+    subtitles = glob.glob(os.path.join(args.subtitle_dir, "*.json"))
+    subtitles.sort()
+    done = load_done_subtitles(args.output_path)
+    subtitles = [s for s in subtitles if s not in done]
+    logger.info(f"{len(done)} subtitles already refined, {len(subtitles)} to go")
+    cache = None
+    if args.cache_path:
+        cache = LLMCache(args.cache_path, max_bytes=args.cache_max_mb << 20)
+
+    if args.engine == "async":
+        with JsonlAppender(args.output_path) as writer:
+            asyncio.run(refine_all_async(subtitles, writer, args, cache))
+    else:
+        run_thread_pool(openai_client, subtitles, args, cache)
 
-    # 等待所有任务完成
-    executor.shutdown()
+    if cache is not None:
+        logger.info(f"LLM cache stats: {cache.stats()}")
+        cache.close()
 
 
 if __name__ == "__main__":
@@ -7,16 +7,23 @@
 """
 
 import argparse
+import bisect
 import glob
 import os
+import subprocess
+from multiprocessing import Pool
 
+import numpy as np
 from loguru import logger
 from moviepy.editor import VideoFileClip
 from tqdm import tqdm
-from Katna.video import Video
-from Katna.writer import KeyFrameDiskWriter
 
-from common import create_logger, read_json, write_json
+import metrics
+from common import JsonlWriter, create_logger, read_json, write_json, write_jsonl
+from extract import get_manifest_path, get_video_name, remove_partial_keyframes
+from keyframe import extract_segments_keyframes
+from media import get_duration, get_keyframes, probe_media
+from transcript import TranscriptStore
 
 
 def get_args():
@@ -53,34 +60,150 @@ def get_args():
         default="/new_disk/cv_group/tanknee/Data/lpl-gpt/2023-spring-split",
         help="视频输出目录",
     )
-    return parser.parse_args()
+    parser.add_argument(
+        "--subtitle_source",
+        type=str,
+        default="bilibili",
+        choices=["bilibili", "transcript"],
+        help="bilibili: 使用 subtitle_dir 中的 B 站字幕; transcript: 使用 recognize.py 保存的 Parquet 转写结果",
+    )
+    parser.add_argument(
+        "--transcript_dir",
+        type=str,
+        default="outputs/transcripts",
+        help="recognize.py --output_format parquet 的输出目录",
+    )
+    parser.add_argument(
+        "--mode",
+        type=str,
+        default="copy",
+        choices=["copy", "reencode"],
+        help="copy: 对齐到关键帧后直接流复制切分; reencode: 使用 moviepy 逐帧精确重编码",
+    )
+    parser.add_argument(
+        "--batch_size", type=int, default=32, help="copy 模式下每个 ffmpeg 进程输出的片段数"
+    )
+    parser.add_argument("--workers", type=int, default=1, help="并行切分的进程数")
+    parser.add_argument(
+        "--clips_per_task",
+        type=int,
+        default=0,
+        help="大于 0 时把单个长视频按片段数拆成多个任务并行处理",
+    )
+    parser.add_argument(
+        "--max_threads",
+        type=int,
+        default=os.cpu_count(),
+        help="所有 ffmpeg 进程的线程总数上限",
+    )
+    parser.add_argument(
+        "--pretty_json",
+        action="store_true",
+        help="片段字幕使用缩进格式保存，默认不缩进以减少大量小文件的写入",
+    )
+    parser.add_argument(
+        "--keyframes",
+        action="store_true",
+        help="切分的同时提取关键帧，整场比赛只解码一遍，之后不必再运行 extract.py",
+    )
+    parser.add_argument("--num_key_frames", type=int, default=15)
+    args = parser.parse_args()
+    if args.keyframes and args.mode != "copy":
+        parser.error("--keyframes 只支持 copy 模式")
+    return args
+
 
+class SubtitleIndex:
+    """按开始时间排序的列式字幕，窗口查询只需两次二分查找"""
 
-def cut_subtitle(subtitle: dict, cut_duration: float):
-    subtitle = subtitle["body"]
-    subtitle = [
-        dict(
-            start=item["from"] - cut_duration,
-            end=item["to"] - cut_duration,
-            text=item["content"],
+    def __init__(self, starts, ends, texts):
+        starts = np.asarray(starts, dtype=np.float64)
+        ends = np.asarray(ends, dtype=np.float64)
+        # 稳定排序，开始时间相同的台词保持原有顺序
+        order = np.argsort(starts, kind="stable")
+        self.starts = starts[order]
+        self.ends = ends[order]
+        texts = [texts[i] for i in order]
+        lengths = np.fromiter((len(t) for t in texts), dtype=np.int64, count=len(texts))
+        self.offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=self.offsets[1:])
+        self.text = "".join(texts)
+
+    @classmethod
+    def from_records(cls, records: list):
+        return cls(
+            [item["start"] for item in records],
+            [item["end"] for item in records],
+            [item["text"] for item in records],
         )
-        for item in subtitle
-        if item["from"] >= cut_duration
-    ]
-    return subtitle
 
+    def __len__(self):
+        return len(self.starts)
+
+    def get_text(self, idx: int) -> str:
+        return self.text[self.offsets[idx] : self.offsets[idx + 1]]
 
-def get_video_subtitle_pairs(raw_video_dir: str, video_dir: str, subtitle_dir: str):
-    video_list = glob.glob(os.path.join(video_dir, "*.mp4"))
+    def search(self, start: float, end: float) -> (int, int):
+        # 返回开始时间落在 [start, end) 内的台词下标范围
+        lo = int(np.searchsorted(self.starts, start, side="left"))
+        hi = int(np.searchsorted(self.starts, end, side="left"))
+        return lo, hi
+
+    def to_records(self, lo: int = 0, hi: int = None) -> list:
+        hi = len(self) if hi is None else hi
+        return [
+            dict(start=start, end=end, text=self.get_text(idx))
+            for idx, start, end in zip(
+                range(lo, hi),
+                self.starts[lo:hi].tolist(),
+                self.ends[lo:hi].tolist(),
+            )
+        ]
+
+
+def cut_subtitle(subtitle: dict, cut_duration: float) -> SubtitleIndex:
+    subtitle = [item for item in subtitle["body"] if item["from"] >= cut_duration]
+    return SubtitleIndex(
+        np.array([item["from"] for item in subtitle], dtype=np.float64) - cut_duration,
+        np.array([item["to"] for item in subtitle], dtype=np.float64) - cut_duration,
+        [item["content"] for item in subtitle],
+    )
+
+
+def cut_transcript(transcript, cut_duration: float) -> SubtitleIndex:
+    # transcript 为 recognize.py 输出的 start,end,text DataFrame，时间轴基于原始视频
+    transcript = transcript[transcript["start"] >= cut_duration]
+    return SubtitleIndex(
+        transcript["start"].to_numpy(dtype=np.float64) - cut_duration,
+        transcript["end"].to_numpy(dtype=np.float64) - cut_duration,
+        transcript["text"].tolist(),
+    )
+
+
+def get_video_subtitle_pairs(
+    raw_video_dir: str,
+    video_dir: str,
+    subtitle_dir: str,
+    subtitle_source: str = "bilibili",
+    transcript_dir: str = None,
+):
+    store = TranscriptStore(transcript_dir) if subtitle_source == "transcript" else None
+    video_list = sorted(glob.glob(os.path.join(video_dir, "*.mp4")))
     video_subtitle_pairs = []
     for video_path in tqdm(video_list, desc="Get video subtitle pairs"):
         video_name = os.path.basename(video_path)
         # 获取视频文件的时长
-        raw_video = VideoFileClip(os.path.join(raw_video_dir, video_name))
-        raw_video_duration = raw_video.duration
-        video = VideoFileClip(video_path)
-        video_duration = video.duration
+        raw_video_duration = get_duration(os.path.join(raw_video_dir, video_name))
+        video_duration = get_duration(video_path)
         cut_duration = raw_video_duration - video_duration
+        if store is not None:
+            transcript_name = video_name.replace(".mp4", "")
+            if not store.is_done(transcript_name):
+                logger.warning(f"Transcript of {video_name} is not finished")
+                continue
+            subtitle = cut_transcript(store.read(transcript_name), cut_duration)
+            video_subtitle_pairs.append((video_path, subtitle))
+            continue
         # 获取字幕文件
         subtitle_name = video_name.replace(".mp4", ".json")
         subtitle_path = os.path.join(subtitle_dir, subtitle_name)
@@ -95,37 +218,121 @@ def get_video_subtitle_pairs(raw_video_dir: str, video_dir: str, subtitle_dir: s
     return video_subtitle_pairs
 
 
-def split_video(video_path: str, subtitle: list, output_dir: str, interval: int = 30):
-    # 根据字幕和时长来拆分视频
-    video = VideoFileClip(video_path)
+def snap_to_keyframe(keyframes: list, timestamp: float) -> float:
+    if not keyframes:
+        return timestamp
+    idx = bisect.bisect_left(keyframes, timestamp)
+    candidates = keyframes[max(idx - 1, 0) : idx + 1]
+    return min(candidates, key=lambda k: abs(k - timestamp))
+
+
+def get_clip_windows(subtitle: SubtitleIndex, duration: float, interval: int = 30):
+    # 根据字幕和时长计算每个片段的起止时间，返回 (开始, 结束, 字幕下标范围)
+    windows = []
     pre_timestamp = 0.0
+    while pre_timestamp + interval < duration:
+        lo, hi = subtitle.search(pre_timestamp, pre_timestamp + interval)
+        timestamp = pre_timestamp
+        if hi > lo:
+            # 保留三位小数
+            timestamp = round(min(float(subtitle.ends[hi - 1]), duration), 3)
+        if timestamp == pre_timestamp:
+            logger.warning(
+                f"Cannot find subtitle between {pre_timestamp} and {pre_timestamp + interval}"
+            )
+            pre_timestamp += interval
+            continue
+        windows.append((pre_timestamp, timestamp, (lo, hi)))
+        pre_timestamp = timestamp
+    return windows
+
+
+def snap_clip(keyframes: list, start: float, end: float) -> (float, float):
+    # copy 模式下片段实际的起止时间
+    snapped_start = snap_to_keyframe(keyframes, start)
+    snapped_end = snap_to_keyframe(keyframes, end)
+    if snapped_end <= snapped_start:
+        # 片段比 GOP 还短时无法对齐，退回原始时间点
+        return start, end
+    return snapped_start, snapped_end
+
+
+def copy_seek(keyframes: list, snapped_start: float) -> float:
+    """流复制时传给 -ss 的时间，片段仍从 snapped_start 处的关键帧开始
+
+    流复制按 dts 丢弃 -ss 之前的数据包，有 B 帧时关键帧的 dts 早于 pts，
+    直接传关键帧时间（或舍入后略大于它的值）会丢掉这个关键帧和整个 GOP。
+    取与上一个关键帧的中点，中点之后、关键帧之前的非关键帧会被丢弃
+    """
+    idx = bisect.bisect_left(keyframes, snapped_start)
+    prev = keyframes[idx - 1] if idx > 0 else 0.0
+    return (prev + snapped_start) / 2
+
+
+def copy_clips(video_path: str, clips: list, keyframes: list, threads: int = 0):
+    # clips: [(start, end, output_path), ...]，一个 ffmpeg 进程读取一次输入，输出多个片段
+    command = ["ffmpeg", "-y", "-v", "error", "-i", video_path]
+    for start, end, output_path in clips:
+        snapped_start, snapped_end = snap_clip(keyframes, start, end)
+        seek = copy_seek(keyframes, snapped_start)
+        if seek > 0:
+            # 输出端 -ss 0 会让流复制的 -t 提前截断，第一个片段不传 -ss
+            command += ["-ss", f"{seek:.6f}"]
+        command += [
+            "-t",
+            f"{snapped_end - seek:.6f}",
+            "-map",
+            "0",
+            "-c",
+            "copy",
+            "-avoid_negative_ts",
+            "make_zero",
+            "-threads",
+            str(threads),
+            output_path,
+        ]
+    with metrics.span("copy_clips"):
+        subprocess.run(command, check=True)
+    metrics.count("clips", len(clips), mode="copy")
+
+
+def split_video(
+    video_path: str,
+    subtitle: SubtitleIndex,
+    output_dir: str,
+    interval: int = 30,
+    mode: str = "copy",
+    batch_size: int = 32,
+    clip_range: tuple = (0, None),
+    threads: int = 0,
+    progress: bool = True,
+    compact_json: bool = True,
+):
+    # 根据字幕和时长来拆分视频，clip_range 指定只处理其中一段片段
     if not os.path.exists(os.path.join(output_dir, "videos")):
-        os.makedirs(os.path.join(output_dir, "videos"))
+        os.makedirs(os.path.join(output_dir, "videos"), exist_ok=True)
         logger.info(f"Create videos directory in {os.path.join(output_dir, 'videos')}")
     if not os.path.exists(os.path.join(output_dir, "subtitles")):
-        os.makedirs(os.path.join(output_dir, "subtitles"))
+        os.makedirs(os.path.join(output_dir, "subtitles"), exist_ok=True)
         logger.info(
             f"Create subtitles directory in {os.path.join(output_dir, 'subtitles')}"
         )
 
+    if mode == "reencode":
+        video = VideoFileClip(video_path)
+        duration = video.duration
+    else:
+        video = None
+        duration = get_duration(video_path)
+        keyframes = get_keyframes(video_path)
+
+    video_name = os.path.basename(video_path).replace(".mp4", "")
     video_clips = []
-    pbar = tqdm(total=video.duration, desc="Split video")
-    while pre_timestamp + interval < video.duration:
-        timestamp = pre_timestamp
-        subtitle_list = []
-        for item in subtitle:
-            if pre_timestamp <= item["start"] < pre_timestamp + interval:
-                # 保留三位小数
-                timestamp = round(min(item["end"], video.duration), 3)
-                subtitle_list.append(item)
-        if timestamp == pre_timestamp:
-            logger.warning(
-                f"Cannot find subtitle between {pre_timestamp} and {pre_timestamp + interval}"
-            )
-            pre_timestamp += interval
-            continue
-        video_clip = video.subclip(pre_timestamp, timestamp)
-        video_name = os.path.basename(video_path).replace(".mp4", "")
+    pending_clips = []
+    windows = get_clip_windows(subtitle, duration, interval)
+    windows = windows[clip_range[0] : clip_range[1]]
+    pbar = tqdm(total=duration, desc="Split video", disable=not progress)
+    for pre_timestamp, timestamp, (lo, hi) in windows:
         video_clip_path = os.path.join(
             output_dir,
             "videos",
@@ -136,44 +343,216 @@ def split_video(video_path: str, subtitle: list, output_dir: str, interval: int
             "subtitles",
             f"{video_name}_{pre_timestamp}_{timestamp}.json",
         )
-        video_clip.write_videofile(video_clip_path)
-        write_json(video_subtitle_path, subtitle_list)
+        if video is not None:
+            with metrics.span("write_videofile"):
+                video.subclip(pre_timestamp, timestamp).write_videofile(
+                    video_clip_path,
+                    threads=threads or None,
+                    logger="bar" if progress else None,
+                )
+            metrics.count("clips", mode="reencode")
+        else:
+            pending_clips.append((pre_timestamp, timestamp, video_clip_path))
+            if len(pending_clips) >= batch_size:
+                copy_clips(video_path, pending_clips, keyframes, threads)
+                pending_clips = []
+        write_json(video_subtitle_path, subtitle.to_records(lo, hi), compact=compact_json)
 
         logger.info(
             f"Split video {video_path} from {pre_timestamp} to {timestamp} with {timestamp - pre_timestamp} seconds"
         )
         pbar.update(timestamp - pre_timestamp)
-        pre_timestamp = timestamp
         video_clips.append((video_clip_path, video_subtitle_path))
 
+    if pending_clips:
+        copy_clips(video_path, pending_clips, keyframes, threads)
+    if video is not None:
+        video.close()
+    pbar.close()
+
     return video_clips
 
 
-def extract_keyframes(video_path: str, output_dir: str, num_key_frames: int = 10):
-    if not os.path.exists(os.path.join(output_dir, "keyframes")):
-        os.makedirs(os.path.join(output_dir, "keyframes"))
-        logger.info(
-            f"Create keyframes directory in {os.path.join(output_dir, 'keyframes')}"
+def split_video_fused(
+    video_path: str,
+    subtitle: SubtitleIndex,
+    output_dir: str,
+    interval: int = 30,
+    num_key_frames: int = 15,
+    batch_size: int = 32,
+    clip_range: tuple = (0, None),
+    threads: int = 0,
+    progress: bool = True,
+    compact_json: bool = True,
+):
+    """copy 模式切分，并从同一遍解码中提取每个片段的关键帧
+
+    流复制切分不解码，关键帧打分只以缩略图解码一遍整场比赛，选中的帧按 GOP 分组 seek 后
+    以原始分辨率写出。返回 [(片段路径, 字幕路径, 状态, 关键帧数量), ...]
+    """
+    video_clips = split_video(
+        video_path,
+        subtitle,
+        output_dir,
+        interval,
+        mode="copy",
+        batch_size=batch_size,
+        clip_range=clip_range,
+        threads=threads,
+        progress=progress,
+        compact_json=compact_json,
+    )
+    keyframe_dir = os.path.join(output_dir, "keyframes")
+    os.makedirs(keyframe_dir, exist_ok=True)
+    # 与 split_video 使用同样的窗口，片段实际从对齐后的关键帧开始
+    keyframes = get_keyframes(video_path)
+    windows = get_clip_windows(subtitle, get_duration(video_path), interval)
+    windows = windows[clip_range[0] : clip_range[1]]
+    segments = []
+    for (start, end, _), (video_clip_path, _) in zip(windows, video_clips):
+        video_name = get_video_name(video_clip_path)
+        remove_partial_keyframes(keyframe_dir, video_name, num_key_frames)
+        segments.append((*snap_clip(keyframes, start, end), video_name))
+    with metrics.span("extract_video_keyframes", engine="fused"):
+        counts = extract_segments_keyframes(
+            video_path,
+            segments,
+            keyframe_dir,
+            probe_media(video_path)["fps"],
+            num_key_frames,
+            threads,
+            keyframes,
         )
-    vd = Video()
-    writer = KeyFrameDiskWriter(location=os.path.join(output_dir, "keyframes"))
-    vd.extract_video_keyframes(
-        no_of_frames=num_key_frames, file_path=video_path, writer=writer
+    metrics.count("keyframes", sum(num_written for num_written, _ in counts))
+    results = []
+    for (video_clip_path, video_subtitle_path), (num_written, num_selected) in zip(
+        video_clips, counts
+    ):
+        # 与 extract.py 一致，选中的帧全部写出才算完成
+        if num_selected == 0:
+            status = "skipped"
+        elif num_written == num_selected:
+            status = "done"
+        else:
+            status = "failed"
+        results.append((video_clip_path, video_subtitle_path, status, num_written))
+    return results
+
+
+def get_split_kwargs(args, threads: int = 0) -> dict:
+    kwargs = dict(
+        output_dir=args.output_dir,
+        batch_size=args.batch_size,
+        threads=threads,
+        compact_json=not args.pretty_json,
     )
+    if args.keyframes:
+        kwargs["num_key_frames"] = args.num_key_frames
+    else:
+        kwargs["mode"] = args.mode
+    return kwargs
+
+
+def split_one(video_path: str, subtitle: SubtitleIndex, **kwargs) -> list:
+    # 传入 num_key_frames 时切分并提取关键帧
+    if "num_key_frames" in kwargs:
+        return split_video_fused(video_path, subtitle, **kwargs)
+    return split_video(video_path, subtitle, **kwargs)
+
+
+def _split_task(task):
+    task_idx, video_path, subtitle, kwargs = task
+    return task_idx, split_one(video_path, subtitle, progress=False, **kwargs)
+
+
+def build_split_tasks(pairs: list, args) -> list:
+    threads = max(1, args.max_threads // args.workers)
+    kwargs = get_split_kwargs(args, threads)
+    tasks = []
+    for video_path, subtitle in pairs:
+        if args.clips_per_task <= 0:
+            tasks.append((len(tasks), video_path, subtitle, kwargs))
+            continue
+        num_clips = len(get_clip_windows(subtitle, get_duration(video_path)))
+        starts = list(range(0, max(num_clips, 1), args.clips_per_task))
+        for i, start in enumerate(starts):
+            # 最后一段不设上界，避免不同方式读取的时长差异导致漏掉片段
+            end = starts[i + 1] if i + 1 < len(starts) else None
+            tasks.append(
+                (len(tasks), video_path, subtitle, dict(kwargs, clip_range=(start, end)))
+            )
+    return tasks
+
+
+def record_keyframes(writer: JsonlWriter, video_clips: list):
+    # 每个任务完成后立即落盘，中断时已完成的片段不会被 extract.py 重做
+    for video_clip_path, _, status, num_frames in video_clips:
+        writer.write(
+            {
+                "video_name": get_video_name(video_clip_path),
+                "status": status,
+                "num_frames": num_frames,
+            }
+        )
+    writer.flush()
+
+
+def split_videos_parallel(pairs: list, args, keyframes_writer: JsonlWriter = None) -> list:
+    tasks = build_split_tasks(pairs, args)
+    logger.info(f"Split {len(pairs)} videos with {len(tasks)} tasks in {args.workers} workers")
+    results = {}
+    with Pool(args.workers) as pool:
+        for task_idx, vc in tqdm(
+            pool.imap_unordered(_split_task, tasks),
+            total=len(tasks),
+            desc="Split videos",
+        ):
+            results[task_idx] = vc
+            if keyframes_writer is not None:
+                record_keyframes(keyframes_writer, vc)
+    # 按任务顺序汇总，保证清单顺序与进程调度无关
+    video_clips = []
+    for task_idx in sorted(results):
+        video_clips.extend(results[task_idx])
+    return video_clips
 
 
 def main():
     create_logger("./logs/split.log")
+    metrics.init("split")
     args = get_args()
     pairs = get_video_subtitle_pairs(
-        args.raw_video_dir, args.video_dir, args.subtitle_dir
+        args.raw_video_dir,
+        args.video_dir,
+        args.subtitle_dir,
+        args.subtitle_source,
+        args.transcript_dir,
     )
-    video_clips = []
-    for video_path, subtitle in tqdm(pairs, desc="Split videos"):
-        vc = split_video(video_path, subtitle, args.output_dir)
-        video_clips.extend(vc)
-    # for video_path, _ in tqdm(video_clips, desc="Extract keyframes"):
-    #     extract_keyframes(video_path, args.output_dir)
+    keyframes_writer = None
+    if args.keyframes:
+        # 与 extract.py 共用清单，之后运行 extract.py 会跳过已完成的片段
+        manifest_path = get_manifest_path(args.output_dir, 0, 1)
+        os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+        keyframes_writer = JsonlWriter(manifest_path)
+    try:
+        if args.workers > 1:
+            video_clips = split_videos_parallel(pairs, args, keyframes_writer)
+        else:
+            video_clips = []
+            kwargs = get_split_kwargs(args)
+            for video_path, subtitle in tqdm(pairs, desc="Split videos"):
+                vc = split_one(video_path, subtitle, **kwargs)
+                if keyframes_writer is not None:
+                    record_keyframes(keyframes_writer, vc)
+                video_clips.extend(vc)
+    finally:
+        if keyframes_writer is not None:
+            keyframes_writer.close()
+    write_jsonl(
+        os.path.join(args.output_dir, "manifest.jsonl"),
+        (dict(video_path=clip[0], subtitle_path=clip[1]) for clip in video_clips),
+    )
+    logger.info(f"Split {len(video_clips)} clips in total")
 
 
 if __name__ == "__main__":
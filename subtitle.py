@@ -3,88 +3,146 @@
 # time = 2023/11/27
 # project = get_subtitle
 import argparse
+import asyncio
 import os
-import time
 
-import requests
-from dotenv import load_dotenv
+import httpx
 from loguru import logger
 from tqdm import tqdm
 
-from common import create_logger, read_jsonl, retry, write_json
-
-load_dotenv()
+import metrics
+from bilibili import (
+    PLAYER_URL,
+    VIEW_URL,
+    get_bvid,
+    get_data,
+    get_subtitle_url,
+    headers,
+)
+from catalog import Catalog, get_part_name
+from common import async_retry, create_logger, write_json
+from ratelimit import AsyncTokenBucket
 
 
 def get_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser()
-    parser.add_argument("--records", type=str, default="config/records-1.jsonl")
+    parser.add_argument(
+        "--records", type=str, default="config/records-1.jsonl", help="导入到目录中的记录"
+    )
+    parser.add_argument("--catalog", type=str, default="config/catalog.sqlite")
     parser.add_argument("--output_dir", type=str, default="subtitles")
+    parser.add_argument("--rpm", type=int, default=60, help="所有请求合计每分钟的上限")
+    parser.add_argument("--connections", type=int, default=8, help="连接池大小")
     return parser.parse_args()
 
 
-headers = {
-    "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/117.0.0.0 Safari/537.36",
-    "Cookie": os.getenv("COOKIE"),
-}
-CID_VID_URL = "http://api.bilibili.com/x/web-interface/view?bvid="
-SUBTITLE_URL = "https://api.bilibili.com/x/player/v2?cid=&s&aid=%s&bvid=%s"
+async def get_json(client: httpx.AsyncClient, bucket: AsyncTokenBucket, url, params=None):
+    host = metrics.get_host(url)
+    with metrics.span("ratelimit.wait", host=host):
+        await bucket.acquire()
+    with metrics.span("http.get", host=host):
+        response = await client.get(url, params=params)
+        response.raise_for_status()
+    metrics.observe("http_response_bytes", len(response.content), host=host)
+    return response.json()
 
-@retry(5)
-def get_cid_vid(bvid: str) -> (str, list):
+
+@async_retry(5)
+async def get_cid_vid(client, bucket, bvid: str) -> (str, list):
     """
     :param bvid:
     :return: aid 和 （cid_list 代表每一场信息）
     """
-    response = requests.get(CID_VID_URL + bvid, headers=headers)
-    text = response.json()
-    aid = text["data"]["aid"]
-    cid_list = [d["cid"] for d in text["data"]["pages"]]
+    view = get_data(await get_json(client, bucket, VIEW_URL, params={"bvid": bvid}))
+    aid = view["aid"]
+    cid_list = [d["cid"] for d in view["pages"]]
     return aid, cid_list
 
-@retry(5)
-def get_subtitle(cid, aid, bvid) -> dict:
-    response = requests.get(
-        "https://api.bilibili.com/x/player/v2?cid=%s&aid=%s&bvid=%s" % (cid, aid, bvid),
-        headers=headers,
+
+@async_retry(5)
+async def get_subtitle(client, bucket, cid, aid, bvid):
+    """返回字幕内容，视频没有字幕时返回 None"""
+    text = await get_json(
+        client, bucket, PLAYER_URL, params={"cid": cid, "aid": aid, "bvid": bvid}
     )
-    text = response.json()
-    try:
-        subtitle_url = (
-            "https:" + text["data"]["subtitle"]["subtitles"][0]["subtitle_url"]
-        )
-    except KeyError:
+    subtitle_url = get_subtitle_url(get_data(text))
+    if subtitle_url is None:
         logger.error(f"糟糕，subtitle_url没有，对应bvid:{bvid},cid:{cid},aid:{aid}")
-        subtitle_url = None
-    response = requests.get(subtitle_url, headers=headers)
-    ret_dict = response.json()
-    return ret_dict
+        return None
+    return await get_json(client, bucket, subtitle_url)
+
+
+async def fetch_record(client, bucket, record, output_dir, catalog: Catalog, pbar):
+    bvid = get_bvid(record["url"])
+    parts = [
+        (get_part_name(record, i), idx - 1)  # 下标从0开始
+        for i, idx in enumerate(record["playlist_idx"])
+    ]
+    todo = []
+    for name, idx in parts:
+        file_name = os.path.join(output_dir, name + ".json")
+        if os.path.exists(file_name):
+            logger.info(f"{file_name}已经存在，跳过")
+            catalog.set_status(name, "subtitle")
+            pbar.update(1)
+        else:
+            todo.append((name, idx, file_name))
+    if not todo:
+        return
+
+    aid, cid_list = await get_cid_vid(client, bucket, bvid)
+
+    async def fetch_part(name, idx, file_name):
+        subtitle_dict = await get_subtitle(client, bucket, cid_list[idx], aid, bvid)
+        if subtitle_dict is None:
+            catalog.set_status(name, "subtitle", "missing")
+        else:
+            # 原子写入，中断时不会留下被当作已完成的半个文件
+            write_json(file_name, subtitle_dict, atomic=True)
+            catalog.set_status(name, "subtitle")
+            metrics.count("subtitles")
+        pbar.update(1)
+
+    await asyncio.gather(*[fetch_part(*part) for part in todo])
+
+
+async def fetch_all(args, catalog: Catalog):
+    records = catalog.records(matches_only=True)
+    bucket = AsyncTokenBucket(args.rpm, capacity=max(1, args.connections))
+    limits = httpx.Limits(
+        max_connections=args.connections, max_keepalive_connections=args.connections
+    )
+    pbar = tqdm(total=sum(len(r["playlist_idx"]) for r in records))
+    async with httpx.AsyncClient(
+        headers={k: v for k, v in headers.items() if v},
+        limits=limits,
+        timeout=30,
+        follow_redirects=True,
+    ) as client:
+        # 所有记录的 cid 并发查询，请求总数由全局令牌桶限速
+        results = await asyncio.gather(
+            *[
+                fetch_record(client, bucket, record, args.output_dir, catalog, pbar)
+                for record in records
+            ],
+            return_exceptions=True,
+        )
+    pbar.close()
+    for record, result in zip(records, results):
+        if isinstance(result, Exception):
+            logger.error(f"获取{record['url']}的字幕失败: {result}")
 
 
 def main(args):
-    records = read_jsonl(args.records)
-    for d in tqdm(records):
-        bvid = d["url"].split("/")[-2]
-        if d["playlist_idx"]:
-            playlist_idx = [i - 1 for i in d["playlist_idx"]]  # 下标从0开始
-            base_file_name = os.path.join(
-                args.output_dir, "_".join(d["teams"]) + "_" + d["date"]
-            )
-            aid, cid_list = get_cid_vid(bvid)
-            for i, idx in enumerate(playlist_idx):
-                file_name = base_file_name + "_" + str(i + 1) + ".json"
-                if os.path.exists(file_name):
-                    logger.info(f"{file_name}已经存在，跳过")
-                    continue
-                subtitle_dict = get_subtitle(cid_list[idx], aid, bvid)
-                write_json(file_name, subtitle_dict)
-                # 五秒进度条
-                for _ in tqdm(range(5)):
-                    time.sleep(1)
+    catalog = Catalog(args.catalog)
+    catalog.import_jsonl(args.records)
+    asyncio.run(fetch_all(args, catalog))
+    catalog.close()
 
 
 if __name__ == "__main__":
     create_logger(log_file="logs/get_subtitle.log")
+    metrics.init("subtitle")
     args = get_args()
     logger.debug(args)
     if not os.path.exists(args.output_dir):
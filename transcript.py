@@ -0,0 +1,88 @@
+"""
+@File    :   transcript.py
+@Time    :   2023/12/08 11:03:26
+@Author  :   TankNee
+@Version :   1.0
+@Desc    :   以 Parquet 分块保存语音识别结果，支持边转写边落盘和断点续转
+"""
+
+import glob
+import os
+
+import pandas as pd
+
+COLUMNS = ["start", "end", "text"]
+DONE_FILE = "_SUCCESS"
+
+
+class TranscriptStore:
+    """每个视频一个目录，每次落盘写一个 part 文件，转写完成后写入 _SUCCESS 标记"""
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def get_dir(self, video_name: str) -> str:
+        return os.path.join(self.root, video_name)
+
+    def list_parts(self, video_name: str) -> list:
+        return sorted(
+            glob.glob(os.path.join(glob.escape(self.get_dir(video_name)), "part-*.parquet"))
+        )
+
+    def is_done(self, video_name: str) -> bool:
+        return os.path.exists(os.path.join(self.get_dir(video_name), DONE_FILE))
+
+    def read(self, video_name: str) -> pd.DataFrame:
+        parts = self.list_parts(video_name)
+        if not parts:
+            return pd.DataFrame(columns=COLUMNS)
+        df = pd.concat([pd.read_parquet(part) for part in parts], ignore_index=True)
+        return df.sort_values("start", kind="stable", ignore_index=True)
+
+    def last_timestamp(self, video_name: str) -> float:
+        # 已落盘的最后一句的结束时间，续转时从这里开始
+        parts = self.list_parts(video_name)
+        if not parts:
+            return 0.0
+        return float(pd.read_parquet(parts[-1], columns=["end"])["end"].max())
+
+    def append(self, video_name: str, rows: list):
+        if not rows:
+            return
+        video_dir = self.get_dir(video_name)
+        os.makedirs(video_dir, exist_ok=True)
+        part_path = os.path.join(
+            video_dir, f"part-{len(self.list_parts(video_name)):05d}.parquet"
+        )
+        # 先写临时文件再重命名，进程中断不会留下损坏的 part
+        tmp_path = part_path + ".tmp"
+        pd.DataFrame(rows, columns=COLUMNS).to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, part_path)
+
+    def finish(self, video_name: str):
+        os.makedirs(self.get_dir(video_name), exist_ok=True)
+        with open(os.path.join(self.get_dir(video_name), DONE_FILE), "w"):
+            pass
+
+
+class TranscriptWriter:
+    """缓存转写出的句子，每 flush_segments 句写一次 part"""
+
+    def __init__(self, store: TranscriptStore, video_name: str, flush_segments: int = 20):
+        self.store = store
+        self.video_name = video_name
+        self.flush_segments = flush_segments
+        self.rows = []
+
+    def write(self, row: list):
+        self.rows.append(row)
+        if len(self.rows) >= self.flush_segments:
+            self.flush()
+
+    def flush(self):
+        self.store.append(self.video_name, self.rows)
+        self.rows = []
+
+    def close(self):
+        self.flush()
+        self.store.finish(self.video_name)